@@ -2,16 +2,22 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 import numpy as np
-import dicom
+import dicom_io
+import texture
+from profiler import PROFILER
+import lut
+from functools import lru_cache
 
 class Image:
     def __init__(self, name: str):
-        self.ds = dicom.read_file(name)
-        self.image_pixels = self.ds.pixel_array
+        self.ds, self.image_pixels = dicom_io.read_file(name)
         self.bits = self.ds[0x280100].value
         self.width, self.height = self.ds[0x280010].value, self.ds[0x280011].value
         self.isColorGreen = False
         self.isBackgroud = False
+        self.textures = texture.TextureManager()
+        # one small frame cache per image, keyed on the toggles
+        self.process = lru_cache(maxsize=4)(self.process)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -19,22 +25,29 @@ class Image:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
+    @PROFILER.timed('draw')
     def draw(self):
-        type_texture = GL_LUMINANCE
-        pixels_to_draw = np.copy(self.image_pixels)
-        if self.isColorGreen:
-            pixels_to_draw = self.get_color_channel(self.transform_gradient(pixels_to_draw))
-            type_texture = GL_RGB
-        if self.isBackgroud:
-            pixels_to_draw = self.get_mask(pixels_to_draw)
-
+        type_texture = GL_RGB if self.isColorGreen else GL_LUMINANCE
+        pixels_to_draw = self.process(self.isColorGreen, self.isBackgroud)
         self.drawTexture(pixels_to_draw, type_texture)
+        PROFILER.overlay()
         glutSwapBuffers()
 
+    @PROFILER.timed('process')
+    def process(self, isColorGreen, isBackgroud):
+        pixels = np.copy(self.image_pixels)
+        if isColorGreen:
+            pixels = self.get_color_channel(self.transform_gradient(pixels))
+        if isBackgroud:
+            pixels = self.get_mask(pixels)
+        return pixels
+
     def get_mask(self, pixels):
         tril_matrix = np.tril_indices(self.height, 0, self. width)
         triu_matrix = np.triu_indices(self.height, 0, self.width)
@@ -43,40 +56,22 @@ class Image:
         return pixels
 
     def transform_gradient(self, pixels):
-        gradient = {}
-        color = 0
-        for key in range(pixels.max(), -1, -1):
-            gradient[key] = color
-            color += 2 if key >= 127 else -2
-
-        vfunc = np.vectorize(lambda x: gradient[x])
-        return vfunc(pixels)
+        return lut.apply(lut.gradient(int(pixels.max()) + 1), pixels)
 
     def get_color_channel(self, pixels):
-        rgb = np.zeros((self.height, self.width, 3))
+        rgb = np.zeros((self.height, self.width, 3), dtype=np.uint8)
         rgb[:, :, 1] = pixels
         return rgb
 
+    @PROFILER.timed('drawTexture')
     def drawTexture(self, data, type_):
-        glTexImage2D(GL_TEXTURE_2D, 0, type_, self.width, self.height, 0, type_, GL_UNSIGNED_BYTE, data)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-
-        glEnable(GL_TEXTURE_2D)
-        glBegin(GL_QUADS)
-        glTexCoord2d(0.0, 0.0)
-        glVertex2d(0.0, 0.0)
-        glTexCoord2d(1.0, 0.0)
-        glVertex2d(self.width, 0.0)
-        glTexCoord2d(1.0, 1.0)
-        glVertex2d(self.width, self.height)
-        glTexCoord2d(0.0, 1.0)
-        glVertex2d(0.0, self.height)
-        glEnd()
-        glDisable(GL_TEXTURE_2D)
+        self.textures.bind('image', data, type_, GL_UNSIGNED_BYTE)
+
+        glCallList(texture.quad(self.width, self.height))
 
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
         if key == 'b':
             self.isBackgroud = not self.isBackgroud
         if key == 'c':
@@ -84,7 +79,7 @@ class Image:
         self.display()
 
     def onMotion(self, x, y):
-        self.display()
+        glutPostRedisplay()
 
 
 def initWindow(width, height):
@@ -1,29 +1,31 @@
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
-import numpy as np
-import dicom
+import dicom_io
+import texture
+from profiler import PROFILER
+import lut
+from functools import lru_cache
 
 
 class Image:
     def __init__(self, name):
-        self.ds = dicom.read_file(name)
+        self.ds, pixels = dicom_io.read_file(name)
         self.bits = self.ds[0x280100].value
+        self.image_pixels = lut.normalize(lut.modality(pixels, *dicom_io.rescale(self.ds)))
         self.data_type = self.image_type()
-        self.image_pixels = self.normalize(self.ds.pixel_array)
         self.width, self.height = self.ds[0x280010].value, self.ds[0x280011].value
         self.normalised = False
         self.inversion = False
         self.x_pos = 0
         self.y_pos = 0
+        self.textures = texture.TextureManager()
+        self.drawn = None
+        # one small frame cache per image, keyed on the toggles
+        self.process = lru_cache(maxsize=4)(self.process)
 
     def image_type(self):
-        intercept = self.ds[0x281052].value
-        slope = self.ds[0x281053].value
-        if intercept != 0 and slope != 1:
-            return GL_FLOAT
-        else:
-            return GL_UNSIGNED_BYTE if self.bits == 8 else GL_UNSIGNED_SHORT
+        return texture.gl_type(self.image_pixels.dtype)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -31,26 +33,43 @@ class Image:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
+    @PROFILER.timed('draw')
     def draw(self):
-        pixels_to_draw = np.copy(self.image_pixels)
-        if self.normalised:
-            pixels_to_draw = self.make_normalization(pixels_to_draw, 0.7, 1)
-        if self.inversion:
-            pixels_to_draw = self.make_inversion(pixels_to_draw)
-
-        self.drawTexture(pixels_to_draw)
-        self.define_coord(pixels_to_draw)
+        if self.drawn is None:
+            self.drawn = self.process(self.normalised, self.inversion)
+            self.drawTexture(self.drawn)
+        else:
+            # nothing but the probe changed: replay the quad over the resident texture
+            glCallList(texture.quad(self.width, self.height))
+        self.define_coord(self.drawn)
+        PROFILER.overlay()
         glutSwapBuffers()
 
-    def normalize(self, pixels):
-        min, max = pixels.min(), pixels.max()
-        new_min, new_max = 0, np.iinfo(pixels.dtype).max
-        arr = (pixels - min)/(max - min)*(new_max - new_min)+new_min
-        return arr.astype(int)
+    @PROFILER.timed('process')
+    def process(self, normalised, inversion):
+        if not (normalised or inversion):
+            return self.image_pixels
+        if self.image_pixels.dtype.kind == 'f':
+            pixels = self.image_pixels
+            if normalised:
+                pixels = self.make_normalization(pixels, 0.7, 1)
+            if inversion:
+                pixels = self.make_inversion(pixels)
+            return pixels
+        lo, hi = int(self.image_pixels.min()), int(self.image_pixels.max())
+        table = lut.identity(hi + 1, self.image_pixels.dtype)
+        if normalised:
+            table = lut.normalization(lo, hi, 0.7, 1, hi + 1, self.image_pixels.dtype)
+        if inversion:
+            t_lo, t_hi = int(table[lo]), int(table[hi])
+            table = lut.compose(table, lut.inversion(t_lo, t_hi, t_hi + 1, table.dtype))
+        return lut.apply(table, self.image_pixels)
 
     def define_coord(self, pixels_to_draw):
         x = self.x_pos
@@ -59,31 +78,22 @@ class Image:
         self.printText(x, y, GLUT_BITMAP_9_BY_15, text)
 
     def make_normalization(self, pixels, p_min, p_max):
-        p_min, p_max = p_min*pixels.max(), p_max*pixels.max()
-        norm = p_min + (pixels - pixels.min())/(pixels.max() - pixels.min())*(p_max-p_min)
-        return norm.astype(int)
+        if pixels.dtype.kind == 'f':
+            return lut.rescale(pixels, pixels.min(), pixels.max(), p_min, p_max)
+        lo, hi = int(pixels.min()), int(pixels.max())
+        return lut.apply(lut.normalization(lo, hi, p_min, p_max, hi + 1, pixels.dtype), pixels)
 
     def make_inversion(self, pixels):
-        inv = pixels.max() - pixels + pixels.min()
-        return inv
+        if pixels.dtype.kind == 'f':
+            return pixels.max() - pixels + pixels.min()
+        lo, hi = int(pixels.min()), int(pixels.max())
+        return lut.apply(lut.inversion(lo, hi, hi + 1, pixels.dtype), pixels)
 
+    @PROFILER.timed('drawTexture')
     def drawTexture(self, data):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.height, 0, GL_LUMINANCE, self.data_type, data)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-
-        glEnable(GL_TEXTURE_2D)
-        glBegin(GL_QUADS)
-        glTexCoord2d(0.0, 0.0)
-        glVertex2d(0.0, 0.0)
-        glTexCoord2d(1.0, 0.0)
-        glVertex2d(self.width, 0.0)
-        glTexCoord2d(1.0, 1.0)
-        glVertex2d(self.width, self.height)
-        glTexCoord2d(0.0, 1.0)
-        glVertex2d(0.0, self.height)
-        glEnd()
-        glDisable(GL_TEXTURE_2D)
+        self.textures.bind('image', data, GL_LUMINANCE, self.data_type)
+
+        glCallList(texture.quad(self.width, self.height))
 
     def getPixelData(self, pixels, y, x):
         return str(pixels[x][y]) if (0 < x < self.width) and (0 < y < self.height) else ''
@@ -96,6 +106,8 @@ class Image:
 
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
+        self.drawn = None
         if key == 'i':
             self.inversion = not self.inversion
         if key == 'n':
@@ -105,7 +117,8 @@ class Image:
     def onMotion(self, x, y):
         self.y_pos = y
         self.x_pos = x
-        self.display()
+        # coalesced by GLUT into one redraw, which only repaints the probe text
+        glutPostRedisplay()
 
 
 def initWindow(width, height):
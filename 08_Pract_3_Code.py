@@ -2,25 +2,25 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 import numpy as np
-import dicom
+import dicom_io
+import texture
+import lut
+from profiler import PROFILER
 
 
 class Image:
     def __init__(self, name):
-        self.ds = dicom.read_file(name)
+        self.ds, pixels = dicom_io.read_file(name)
         self.bits = self.ds[0x280100].value
+        self.image_pixels = lut.normalize(lut.modality(pixels, *dicom_io.rescale(self.ds)))
         self.data_type = self.image_type()
-        self.image_pixels = self.normalize(self.ds.pixel_array)
         self.width, self.height = self.ds[0x280010].value, self.ds[0x280011].value
         self.filterSobel = False
+        self.textures = texture.TextureManager()
+        self.sobel = None
 
     def image_type(self):
-        intercept = self.ds[0x281052].value
-        slope = self.ds[0x281053].value
-        if intercept != 0 and slope != 1:
-            return GL_FLOAT
-        else:
-            return GL_UNSIGNED_BYTE if self.bits == 8 else GL_UNSIGNED_SHORT
+        return texture.gl_type(self.image_pixels.dtype)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -28,78 +28,69 @@ class Image:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
+    @PROFILER.timed('draw')
     def draw(self):
-        pixels_to_draw = np.copy(self.image_pixels)
+        pixels_to_draw = self.image_pixels
         if self.filterSobel:
-            pixels_to_draw = self.filtration(pixels_to_draw)
+            if self.sobel is None:
+                self.sobel = self.filtration(self.image_pixels)
+            pixels_to_draw = self.sobel
 
         self.drawTexture(pixels_to_draw)
+        PROFILER.overlay()
         glutSwapBuffers()
 
-    def filtration(self, pixels):
+    @PROFILER.timed('filtration')
+    def filtration(self, pixels, out=None, tile=256):
+        if out is None:
+            out = np.empty(pixels.shape, dtype=pixels.dtype)
         bord_pixel = self.add_pixels(pixels, 1)
-        filtered = np.zeros(pixels.shape)
-        for i in range(self.height):
-            for j in range(self.width):
-                filtered[i, j] = self.Sobel(bord_pixel[i:i+3, j:j+3])
-        return filtered
-
-    def Sobel(self, slice):
-        maskX = np.array([[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]])
-        maskY = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
-        return np.sqrt((maskX*slice).sum()**2 + (maskY*slice).sum()**2)
+        for top in range(0, pixels.shape[0], tile):
+            bottom = min(top + tile, pixels.shape[0])
+            self.Sobel(bord_pixel[top:bottom+2], out[top:bottom])
+        return out
+
+    def Sobel(self, slice, out):
+        # separable kernels: maskX = [1, 1, 1]^T x [-1, 0, 1], maskY = [-1, 0, 1]^T x [1, 2, 1]
+        slice = slice.astype(np.result_type(out.dtype, np.float32))
+        diff = slice[:, 2:] - slice[:, :-2]
+        smooth = slice[:, :-2] + 2*slice[:, 1:-1] + slice[:, 2:]
+        gx = diff[:-2] + diff[1:-1] + diff[2:]
+        gy = smooth[2:] - smooth[:-2]
+        magnitude = np.hypot(gx, gy, out=gx)
+        if out.dtype.kind in 'ui':
+            np.clip(magnitude, 0, np.iinfo(out.dtype).max, out=magnitude)
+            np.rint(magnitude, out=magnitude)
+        out[...] = magnitude
+        return out
 
     def add_pixels(self, pixels, border_size):
-        h, w = pixels.shape
-        new_h, new_w = h+2*border_size, w+2*border_size
-        pixels_new = np.zeros((new_h, new_w))
-
-        for i in range(new_h):
-            for j in range(new_w):
-                pixels_new[i, j] = pixels[(i - border_size) % h][(j - border_size) % w]
-        return pixels_new
-
-    def normalize(self, pixels):
-        min, max = pixels.min(), pixels.max()
-        new_min, new_max = 0, np.iinfo(pixels.dtype).max
-        arr = (pixels - min)/(max - min)*(new_max - new_min)+new_min
-        return arr.astype(int)
+        return np.pad(pixels, border_size, mode='wrap')
 
+    @PROFILER.timed('drawTexture')
     def drawTexture(self, data):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.height, 0,
-                     GL_LUMINANCE,  self.data_type, data)
-
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-
-        glEnable(GL_TEXTURE_2D)
-        glBegin(GL_QUADS)
-        glTexCoord2d(0.0, 0.0)
-        glVertex2d(0.0, 0.0)
-        glTexCoord2d(1.0, 0.0)
-        glVertex2d(self.width, 0.0)
-        glTexCoord2d(1.0, 1.0)
-        glVertex2d(self.width, self.height)
-        glTexCoord2d(0.0, 1.0)
-        glVertex2d(0.0, self.height)
-        glEnd()
-        glDisable(GL_TEXTURE_2D)
+        self.textures.bind('image', data, GL_LUMINANCE, self.data_type)
+
+        glCallList(texture.quad(self.width, self.height))
 
     def getPixelData(self, pixels, y, x):
         return str(pixels[x][y]) if (0 < x < self.width) and (0 < y < self.height) else ''
 
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
         if key == 'f':
             self.filterSobel = not self.filterSobel
         self.display()
 
     def onMotion(self, x, y):
-        self.display()
+        glutPostRedisplay()
 
 
 def initWindow(width, height):
@@ -2,28 +2,30 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 import numpy as np
-import dicom
-import operator
-import pickle
+import dicom_io
 from pprint import pprint
+import threshold
+import texture
+import lut
+from profiler import PROFILER
 
 
 class Image:
     def __init__(self, name):
-        self.ds = dicom.read_file(name)
+        self.ds, pixels = dicom_io.read_file(name)
         self.bits = self.ds[0x280100].value
+        self.image_pixels = lut.normalize(lut.modality(pixels, *dicom_io.rescale(self.ds)))
         self.data_type = self.image_type()
-        self.image_pixels = self.normalize(self.ds.pixel_array)
         self.width, self.height = self.ds[0x280010].value, self.ds[0x280011].value
         self.filtered = False
+        self.hist_cache = None
+        self.mask_cache = None
+        self.verbose = False
+        self.packed = False
+        self.textures = texture.TextureManager()
 
     def image_type(self):
-        intercept = self.ds[0x281052].value
-        slope = self.ds[0x281053].value
-        if intercept != 0 and slope != 1:
-            return GL_FLOAT
-        else:
-            return GL_UNSIGNED_BYTE if self.bits == 8 else GL_UNSIGNED_SHORT
+        return texture.gl_type(self.image_pixels.dtype)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -31,82 +33,90 @@ class Image:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
+    @PROFILER.timed('draw')
     def draw(self):
-        pixels_to_draw = np.copy(self.image_pixels)
+        pixels_to_draw = self.image_pixels
         if self.filtered:
-            pixels_to_draw = self.make_filtration(pixels_to_draw)
+            pixels_to_draw = self.make_filtration(self.image_pixels)
         self.drawTexture(pixels_to_draw)
+        PROFILER.overlay()
         glutSwapBuffers()
 
+    @PROFILER.timed('make_filtration')
     def make_filtration(self, pixels):
-        hist = {key: (pixels == key).sum() for key in range(pixels.min(), pixels.max())}
-        li = np.array(list(hist.values()))
-        pmin, pmax =np.where(li==np.min(li[np.nonzero(li)]))[0][0], int(np.argmax(li))
+        # redraws reuse the mask; files are only written by export
+        if self.mask_cache is None or self.mask_cache[0] is not pixels:
+            self.mask_cache = (pixels, self.segment(pixels))
+        return self.mask_cache[1]
+
+    def export(self, pixels, name='filename'):
+        mask = self.make_filtration(pixels)
+        self.save(mask, pixels, name)
+        if self.verbose:
+            pprint([{'x': x, 'y': y, 'mask': mask[x, y], 'value': pixels[x, y]}
+                    for x in range(pixels.shape[0]) for y in range(pixels.shape[1])])
+        return mask
 
-        x = [el for el in reversed(range(pmax, pmin+1, 1))]
-        dist = {key: self.distance(pmin, pmax, key, hist[pmin], hist[pmax], hist[key]) for key in x}
-        tresh = max(dist.items(), key=operator.itemgetter(1))[0]
+    def segment(self, pixels):
+        hist, lo, step = self.histogram(pixels)
+        # the top intensity stays out of the search range, as before
+        tresh = lo + step*threshold.triangle(hist[:-1])
 
         mask = np.copy(pixels)
         mask[mask < tresh] = 0
-        mask[mask >= tresh] = np.iinfo(pixels.dtype).max
-        table = [{'x': x, 'y': y, 'mask': mask[x, y], 'value': pixels[x, y]}
-                 for x in range(pixels.shape[0]) for y in range(pixels.shape[1])]
-        self.save(table)
-        pprint(table)
+        mask[mask >= tresh] = lut.white(pixels.dtype)
         return mask
 
-    def save(self, data):
-        with open('filename.pickle', 'wb') as handle:
-            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    def distance(self, x1, x2, x3, y1, y2, y3):
-        A, B, C = self.line(x1, x2, y1, y2)
-        dist = np.abs(A*x3 + B*y3 + C)/np.sqrt(A**2 + B**2)
-        return dist
-
-    def line(self, x1, x2, y1, y2):
-        A = y2 - y1
-        B = -(x2 - x1)
-        C = -x1*(y2 - y1) + y2*(x2 - x1)
-        return A, B, C
-
-    def normalize(self, pixels):
-        min, max = pixels.min(), pixels.max()
-        new_min, new_max = 0, np.iinfo(pixels.dtype).max
-        arr = (pixels - min)/(max - min)*(new_max - new_min)+new_min
-        return arr.astype(int)
-
+    def save(self, mask, pixels, name='filename'):
+        if self.packed:
+            mask = np.packbits(mask > 0, axis=1)
+        np.save(name + '_mask.npy', mask)
+        np.save(name + '_value.npy', pixels)
+
+    def load_row(self, x, name='filename'):
+        mask = np.load(name + '_mask.npy', mmap_mode='r')
+        values = np.load(name + '_value.npy', mmap_mode='r')
+        row = np.array(mask[x])
+        if mask.shape != values.shape:
+            row = np.unpackbits(row)[:values.shape[1]].astype(values.dtype) * lut.white(values.dtype)
+        return row, np.array(values[x])
+
+    def load_pixel(self, x, y, name='filename'):
+        mask, values = self.load_row(x, name)
+        return mask[y], values[y]
+
+    def histogram(self, pixels):
+        if self.hist_cache is None or self.hist_cache[0] is not pixels:
+            self.hist_cache = (pixels,) + threshold.histogram(pixels)
+        return self.hist_cache[1:]
+
+    @PROFILER.timed('drawTexture')
     def drawTexture(self, data):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.height, 0, GL_LUMINANCE, self.data_type, data)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-
-        glEnable(GL_TEXTURE_2D)
-        glBegin(GL_QUADS)
-        glTexCoord2d(0.0, 0.0)
-        glVertex2d(0.0, 0.0)
-        glTexCoord2d(1.0, 0.0)
-        glVertex2d(self.width, 0.0)
-        glTexCoord2d(1.0, 1.0)
-        glVertex2d(self.width, self.height)
-        glTexCoord2d(0.0, 1.0)
-        glVertex2d(0.0, self.height)
-        glEnd()
-        glDisable(GL_TEXTURE_2D)
+        self.textures.bind('image', data, GL_LUMINANCE, self.data_type)
+
+        glCallList(texture.quad(self.width, self.height))
 
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
         if key == 'f':
             self.filtered = not self.filtered
+        if key == 'p':
+            self.verbose = not self.verbose
+        if key == 'k':
+            self.packed = not self.packed
+        if key == 'e':
+            self.export(self.image_pixels)
         self.display()
 
     def onMotion(self, x, y):
-        self.display()
+        glutPostRedisplay()
 
 
 def initWindow(width, height):
@@ -2,28 +2,30 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 import numpy as np
-import dicom
+import dicom_io
 from scipy.interpolate import RectBivariateSpline
+from scipy.linalg import cholesky_banded, cho_solve_banded
 from scipy import ndimage as ndi
 from tqdm import tqdm
+import texture
+import lut
+from profiler import PROFILER
 
 
 class Image:
     def __init__(self, name):
-        self.ds = dicom.read_file(name)
+        self.ds, pixels = dicom_io.read_file(name)
         self.bits = self.ds[0x280100].value
+        self.image_pixels = lut.normalize(lut.modality(pixels, *dicom_io.rescale(self.ds)))
         self.data_type = self.image_type()
-        self.image_pixels = self.normalize(self.ds.pixel_array)
         self.width, self.height = self.ds[0x280010].value, self.ds[0x280011].value
         self.bordered = False
+        self.fields = {}
+        self.contours = {}
+        self.textures = texture.TextureManager()
 
     def image_type(self):
-        intercept = self.ds[0x281052].value
-        slope = self.ds[0x281053].value
-        if intercept != 0 and slope != 1:
-            return GL_FLOAT
-        else:
-            return GL_UNSIGNED_BYTE if self.bits == 8 else GL_UNSIGNED_SHORT
+        return texture.gl_type(self.image_pixels.dtype)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -31,16 +33,19 @@ class Image:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
+    @PROFILER.timed('draw')
     def draw(self):
-        pixels_to_draw = np.copy(self.image_pixels)
-        self.drawTexture(pixels_to_draw)
+        self.drawTexture(self.image_pixels)
         if self.bordered:
-            points = self.activation_border(pixels_to_draw)
+            points = self.activation_border()
             self.drawPoints(points)
+        PROFILER.overlay()
         glutSwapBuffers()
 
     def drawPoints(self, points):
@@ -61,38 +66,43 @@ class Image:
                 glVertex2f(points[0, 1], points[0, 0])
         glEnd()
 
-    def activation_border(self, pixels):
-        s = np.linspace(0, 2 * np.pi, 15)
-        r = np.linspace(10, 21, len(s))*s
-        c = list(np.linspace(10, 35, len(s))*s+10)
-        init = np.array([r, c]).T
-        snake = self.active_contour(self.gaussian(pixels, 5), init,
-                                    alpha=0.015, beta=10, gamma=0.001)
-        return snake
-
-    def active_contour(self, image, snake, alpha=100, beta=90, gamma=1001, max_px_move=4.0,
+    @PROFILER.timed('activation_border')
+    def activation_border(self, sigma=5, alpha=0.015, beta=10, gamma=0.001):
+        key = (sigma, alpha, beta, gamma)
+        if key not in self.contours:
+            s = np.linspace(0, 2 * np.pi, 15)
+            r = np.linspace(10, 21, len(s))*s
+            c = list(np.linspace(10, 35, len(s))*s+10)
+            init = np.array([r, c]).T
+            self.contours[key] = self.active_contour(self.gradient_field(sigma), init,
+                                                     alpha=alpha, beta=beta, gamma=gamma)
+        return self.contours[key]
+
+    def gradient_field(self, sigma):
+        if sigma not in self.fields:
+            img = self.gaussian(self.image_pixels, sigma)
+            img = img / img.max()
+            self.fields[sigma] = RectBivariateSpline(np.arange(img.shape[1]), np.arange(img.shape[0]), img.T,
+                                                     kx=2, ky=2, s=0)
+        return self.fields[sigma]
+
+    def active_contour(self, intp, snake, alpha=100, beta=90, gamma=1001, max_px_move=4.0,
                        max_iterations=10, convergence=0.0001):
 
         snake_xy = snake[:, ::-1]
         convergence_order = 10
-        img = image / image.max()
-        intp = RectBivariateSpline(np.arange(img.shape[1]), np.arange(img.shape[0]), img.T, kx=2, ky=2, s=0)
 
-        x, y = snake_xy[:, 0].astype(np.float), snake_xy[:, 1].astype(np.float)
+        x, y = snake_xy[:, 0].astype(np.float64), snake_xy[:, 1].astype(np.float64)
         n = len(x)
         xsave = np.empty((convergence_order, len(x)))
         ysave = np.empty((convergence_order, len(x)))
 
-        a = np.roll(np.eye(n), -1, axis=0) + np.roll(np.eye(n), -1, axis=1) - 2 * np.eye(n)
-        b = np.roll(np.eye(n), -2, axis=0) + np.roll(np.eye(n), -2, axis=1) - 4 * np.roll(np.eye(n), -1, axis=0) - \
-            4 * np.roll(np.eye(n), -1, axis=1) + 6 * np.eye(n)
-        A = -alpha * a + beta * b
-        inv = np.linalg.inv(A + gamma * np.eye(n))
+        system = self.snake_system(n, alpha, beta, gamma)
 
         # energy minimization:
         for i in tqdm(range(max_iterations)):
             fx, fy = intp(x, y, dx=1, grid=False), intp(x, y, dy=1, grid=False)
-            xn, yn = inv @ (gamma * x + fx), inv @ (gamma * y + fy)
+            xn, yn = self.solve_cyclic(system, np.stack([gamma * x + fx, gamma * y + fy], axis=1)).T
             dx, dy = max_px_move * np.tanh(xn - x), max_px_move * np.tanh(yn - y)
             x += dx
             y += dy
@@ -102,38 +112,45 @@ class Image:
 
         return np.stack([y, x], axis=1)
 
+    def snake_system(self, n, alpha, beta, gamma):
+        # A + gamma*I is cyclic pentadiagonal: a banded SPD part plus the four wrap-around corners
+        ab = np.empty((3, n))
+        ab[0] = beta
+        ab[1] = -alpha - 4 * beta
+        ab[2] = 2 * alpha + 6 * beta + gamma
+        chol = cholesky_banded(ab)
+
+        corners = np.array([0, 1, n - 2, n - 1])
+        W = np.zeros((4, 4))
+        W[0, 3] = W[3, 0] = -alpha - 4 * beta
+        W[0, 2] = W[2, 0] = W[1, 3] = W[3, 1] = beta
+        U = np.zeros((n, 4))
+        U[corners, np.arange(4)] = 1
+        Z = cho_solve_banded((chol, False), U)
+        K = np.linalg.solve(np.eye(4) + W @ Z[corners], W)
+        return chol, corners, Z, K
+
+    def solve_cyclic(self, system, rhs):
+        # Woodbury correction of the banded solve for the corner entries
+        chol, corners, Z, K = system
+        y = cho_solve_banded((chol, False), rhs)
+        return y - Z @ (K @ y[corners])
+
     def gaussian(self, image, sigma=1):
-        image = image / np.iinfo(image.dtype).max
+        image = np.divide(image, lut.white(image.dtype), dtype=np.float32)
         output = np.empty_like(image)
         ndi.gaussian_filter(image, sigma, output=output)
         return output
 
-    def normalize(self, pixels):
-        min, max = pixels.min(), pixels.max()
-        new_min, new_max = 0, np.iinfo(pixels.dtype).max
-        arr = (pixels - min)/(max - min)*(new_max - new_min)+new_min
-        return arr.astype(int)
-
+    @PROFILER.timed('drawTexture')
     def drawTexture(self, data):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.height, 0, GL_LUMINANCE, self.data_type, data)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-
-        glEnable(GL_TEXTURE_2D)
-        glBegin(GL_QUADS)
-        glTexCoord2d(0.0, 0.0)
-        glVertex2d(0.0, 0.0)
-        glTexCoord2d(1.0, 0.0)
-        glVertex2d(self.width, 0.0)
-        glTexCoord2d(1.0, 1.0)
-        glVertex2d(self.width, self.height)
-        glTexCoord2d(0.0, 1.0)
-        glVertex2d(0.0, self.height)
-        glEnd()
-        glDisable(GL_TEXTURE_2D)
+        self.textures.bind('image', data, GL_LUMINANCE, self.data_type)
+
+        glCallList(texture.quad(self.width, self.height))
 
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
         if key == 'b':
             self.bordered = not self.bordered
         self.display()
@@ -1,25 +1,31 @@
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
+from collections import OrderedDict
 import numpy as np
-import dicom
+from scipy import ndimage as ndi
+import dicom_io
+import texture
+import lut
+from profiler import PROFILER
 
 
 class Image:
-    def __init__(self, name):
-        self.ds = dicom.read_file(name)
+    def __init__(self, name, capacity=4):
+        self.ds, pixels = dicom_io.read_file(name)
         self.bits = self.ds[0x280100].value
+        self.image_pixels = lut.normalize(lut.modality(pixels, *dicom_io.rescale(self.ds)))
         self.data_type = self.image_type()
-        self.image_pixels = self.normalize(self.ds.pixel_array)
         self.width, self.height = self.ds[0x280010].value, self.ds[0x280011].value
+        self.textures = texture.TextureManager()
+        self.tiles = texture.TileCache(self.textures)
+        self.pyramid_cache = None
+        self.matrix = np.eye(4)
+        self.resampled = OrderedDict()
+        self.capacity = capacity
 
     def image_type(self):
-        intercept = self.ds[0x281052].value
-        slope = self.ds[0x281053].value
-        if intercept != 0 and slope != 1:
-            return GL_FLOAT
-        else:
-            return GL_UNSIGNED_BYTE if self.bits == 8 else GL_UNSIGNED_SHORT
+        return texture.gl_type(self.image_pixels.dtype)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -28,71 +34,140 @@ class Image:
         gluOrtho2D(-self.width, self.width, -self.height, self.height)
         # glMatrixMode(GL_MODELVIEW)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
+    @PROFILER.timed('draw')
     def draw(self):
-        pixels_to_draw = np.copy(self.image_pixels)
-        self.drawTexture(pixels_to_draw)
+        self.drawTexture(self.image_pixels)
+        PROFILER.overlay()
         glutSwapBuffers()
 
-    def normalize(self, pixels):
-        min, max = pixels.min(), pixels.max()
-        new_min, new_max = 0, np.iinfo(pixels.dtype).max
-        arr = (pixels - min)/(max - min)*(new_max - new_min)+new_min
-        return arr.astype(int)
-
+    def pyramid(self, data):
+        if self.pyramid_cache is None or self.pyramid_cache.levels[0] is not data:
+            self.pyramid_cache = texture.Pyramid(data)
+            self.tiles.clear()
+        return self.pyramid_cache
+
+    def visible(self, rows, cols):
+        # window corners taken back through the current transforms into pixel coordinates
+        modelview = glGetDoublev(GL_MODELVIEW_MATRIX)
+        projection = glGetDoublev(GL_PROJECTION_MATRIX)
+        viewport = glGetIntegerv(GL_VIEWPORT)
+        x0, y0, width, height = viewport
+        corners = np.array([gluUnProject(x, y, 0, modelview, projection, viewport)[:2]
+                            for x in (x0, x0 + width) for y in (y0, y0 + height)])
+        col = (corners[:, 0] + self.width/2)*cols/self.width
+        row = (corners[:, 1] + self.height/2)*rows/self.height
+        scale = max((col.max() - col.min())/width, (row.max() - row.min())/height)
+        return (row.min(), row.max(), col.min(), col.max()), scale
+
+    @PROFILER.timed('drawTexture')
     def drawTexture(self, data):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.height, 0, GL_LUMINANCE, self.data_type, data)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        rows, cols = data.shape[:2]
+        pyramid = self.pyramid(data)
+        rect, scale = self.visible(rows, cols)
+        level = pyramid.level(scale)
 
         glEnable(GL_TEXTURE_2D)
-        glBegin(GL_QUADS)
-        glTexCoord2d(0.0, 0.0)
-        glVertex2d(-self.width/2, -self.height/2)
-        glTexCoord2d(1.0, 0.0)
-        glVertex2d(self.width/2, -self.height/2)
-        glTexCoord2d(1.0, 1.0)
-        glVertex2d(self.width/2, self.height/2)
-        glTexCoord2d(0.0, 1.0)
-        glVertex2d(-self.width/2, self.height/2)
-        glEnd()
+        for key in pyramid.tiles(level, *rect):
+            tile = self.tiles.bind(pyramid, key, GL_LUMINANCE, self.data_type)
+            top, bottom, left, right = pyramid.extent(key)
+            s = (right - left)/(tile.shape[1] << level)
+            t = (bottom - top)/(tile.shape[0] << level)
+            x0, x1 = -self.width/2 + left*self.width/cols, -self.width/2 + right*self.width/cols
+            y0, y1 = -self.height/2 + top*self.height/rows, -self.height/2 + bottom*self.height/rows
+            glBegin(GL_QUADS)
+            glTexCoord2d(0.0, 0.0)
+            glVertex2d(x0, y0)
+            glTexCoord2d(s, 0.0)
+            glVertex2d(x1, y0)
+            glTexCoord2d(s, t)
+            glVertex2d(x1, y1)
+            glTexCoord2d(0.0, t)
+            glVertex2d(x0, y1)
+            glEnd()
         glDisable(GL_TEXTURE_2D)
 
+    def mirror(self, xp):
+        return np.array([[-1, 0, 0, 0],
+                         [0, 1, 0, 0],
+                         [0, 0, 1, 0],
+                         [2*xp, 0, 0, 1]])
+
+    def scale(self, Sx, Sy):
+        return np.array([[Sx, 0, 0, 0],
+                         [0, Sy, 0, 0],
+                         [0, 0, 1, 0],
+                         [0, 0, 0, 1]])
+
+    def rotate(self, angle):
+        c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+        return np.array([[c, s, 0, 0],
+                         [-s, c, 0, 0],
+                         [0, 0, 1, 0],
+                         [0, 0, 0, 1]])
+
+    def multiply(self, matrix):
+        # matrices are in GL's column-major layout; self.matrix mirrors the modelview
+        glMultMatrixf(matrix)
+        self.matrix = self.matrix @ np.transpose(matrix)
+
+    def transformed(self, order=1):
+        key = (self.matrix.tobytes(), order)
+        if key in self.resampled:
+            self.resampled.move_to_end(key)
+            return self.resampled[key]
+        self.resampled[key] = self.resample(self.image_pixels, self.matrix, order)
+        while len(self.resampled) > self.capacity:
+            self.resampled.popitem(last=False)
+        return self.resampled[key]
+
+    def resample(self, pixels, matrix, order=1):
+        # pixel centres sit around the origin as in drawTexture; the output canvas is the
+        # bounding box of the transformed image
+        rows, cols = pixels.shape
+        A, t = matrix[:2, :2], matrix[:2, 3]
+        corners = np.array([[x, y] for x in (-cols/2, cols/2) for y in (-rows/2, rows/2)]) @ A.T + t
+        lo, hi = corners.min(axis=0), corners.max(axis=0)
+        shape = tuple(np.maximum(np.ceil(np.round(hi - lo, 6)).astype(int), 1)[::-1])
+
+        inverse = np.linalg.inv(A)[::-1, ::-1]
+        offset = inverse @ (lo + 0.5 - t)[::-1] + (rows/2 - 0.5, cols/2 - 0.5)
+        output = ndi.affine_transform(pixels, inverse, offset, output_shape=shape, output=np.float32,
+                                      order=order, mode='grid-constant', cval=0)
+        if pixels.dtype.kind in 'ui':
+            np.clip(output, 0, lut.white(pixels.dtype), out=output)
+            np.rint(output, out=output)
+        return output.astype(pixels.dtype)
+
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
         if key == '1':
             xp = int(input('Enter the X (for mirror): '))
-            matrix = np.array([-1, 0, 0, 0,
-                                0, 1, 0, 0,
-                                0, 0, 1, 0,
-                                2*xp, 0, 0, 1])
-            glMultMatrixf(matrix)
+            self.multiply(self.mirror(xp))
         elif key == '2':
             Sx = float(input('Scaling coef Sx : '))
             Sy = float(input('Scaling coef Sy : '))
-            matrix = np.array([Sx, 0, 0, 0,
-                                0, Sy, 0, 0,
-                                0, 0, 1, 0,
-                                0, 0, 0, 1])
-            glMultMatrixf(matrix)
+            self.multiply(self.scale(Sx, Sy))
         elif key == '3':
             xp = int(input('Enter the X (for mirror): '))
-            matrix1 = np.array([[-1, 0, 0, 0],
-                               [0, 1, 0, 0],
-                               [0, 0, 1, 0],
-                               [2 * xp, 0, 0, 1]])
             Sx = float(input('Scaling coef Sx : '))
             Sy = float(input('Scaling coef Sy : '))
-            matrix2 = np.array([[Sx, 0, 0, 0],
-                               [0, Sy, 0, 0],
-                               [0, 0, 1, 0],
-                               [0, 0, 0, 1]])
-            glMultMatrixf(matrix1 @ matrix2)
+            self.multiply(self.mirror(xp) @ self.scale(Sx, Sy))
         elif key == '4':
             glLoadIdentity()
+            self.matrix = np.eye(4)
+        elif key == '5':
+            angle = float(input('Rotation angle, degrees : '))
+            self.multiply(self.rotate(angle))
+        elif key == 'e':
+            order = int(input('Interpolation order (0-5) : '))
+            np.save('transformed.npy', self.transformed(order))
         self.display()
 
 
@@ -1,46 +1,57 @@
 from OpenGL.GL import *
 from OpenGL.GLUT import *
 import numpy as np
-import dicom
-import os
+import texture
+import lut
+from profiler import PROFILER
+import dicom_io
+import volume
 
 
 class Image:
-    def __init__(self, name):
-        self.n = len(os.listdir(name))
-
-        image_pixels = []
-        for i, file in enumerate(sorted(os.listdir(name))):
-            ds = dicom.read_file(os.path.join(name, file))
-            self.data_type = self.image_type(ds)
-            image_pixels.append(self.normalize(ds.pixel_array))
-
-        self.image_pixels = np.array(image_pixels)
+    def __init__(self, name, progressive=False):
+        if progressive:
+            # the preview shows at once; poll swaps in the full volume when the loader finishes
+            self.loader = dicom_io.SeriesLoader(name)
+            ds = self.loader.ds
+            self.set_pixels(self.loader.volume, lut.unsigned(self.loader.volume.dtype))
+            self.ready = self.loader.loaded
+        else:
+            self.loader = None
+            pixels, ds, self.stats = dicom_io.load_volume(name)
+            self.set_pixels(self.stats.normalize(pixels))
+        self.n = len(self.image_pixels)
         self.width, self.height = ds[0x280010].value, ds[0x280011].value
         self.slice = ds[0x180050].value
         self.space = ds[0x180088].value
 
-        self.front_pixels = np.zeros((self.height, self.n, self.width))
-        for i in range(self.height):
-            for j in range(self.n):
-                for k in range(self.width):
-                    self.front_pixels[i][j][k] = self.image_pixels[j][i][k]
-
-        self.sag_pixels = np.zeros((self.width, self.n, self.height))
-        for i in range(self.width):
-            for j in range(self.n):
-                for k in range(self.height):
-                    self.sag_pixels[i][j][k] = self.image_pixels[j][k][i]
-
         self.cor_layer, self.sag_layer, self.front_layer = 0, 0, 0
+        self.textures = texture.TextureManager()
+        self.volume_mode = False
+        self.oblique = False
+        self.theta, self.phi, self.offset = 0, 0, 0
 
-    def image_type(self, ds):
-        intercept = ds[0x281052].value
-        slope = ds[0x281053].value
-        if intercept != 0 and slope != 1:
-            return GL_FLOAT
-        else:
-            return GL_UNSIGNED_BYTE if ds[0x280100].value == 8 else GL_UNSIGNED_SHORT
+    def set_pixels(self, pixels, dtype=None):
+        self.image_pixels = pixels
+        self.data_type = texture.gl_type(dtype or pixels.dtype)
+        self.planes = {'axial': pixels,
+                       'coronal': pixels.transpose(1, 0, 2),
+                       'sagittal': pixels.transpose(2, 0, 1)}
+        self.reslicer = None
+
+    def poll(self, value):
+        if self.loader.done.is_set():
+            if self.loader.error is not None:
+                raise RuntimeError('loading %s failed' % self.loader.path) from self.loader.error
+            self.stats = self.loader.stats
+            self.set_pixels(self.loader.pixels)
+            self.loader = None
+            glutPostRedisplay()
+            return
+        if self.loader.loaded != self.ready:
+            self.ready = self.loader.loaded
+            glutPostRedisplay()
+        glutTimerFunc(100, self.poll, 0)
 
     def init(self):
         glClearColor(0, 0, 0, 0.0)
@@ -52,8 +63,10 @@ class Image:
         glRotatef(-45, 1, 0, 0)
         glRotatef(45, 0, 0, 1)
 
+    @PROFILER.timed('display')
     def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
+        self.textures.begin_frame()
         self.draw()
 
     def printText(self, x, y, z, font, text):
@@ -75,22 +88,31 @@ class Image:
         self.printText(0.05, -1.2, 0, GLUT_BITMAP_HELVETICA_18, "y")
         self.printText(0.05, 0, 0.9, GLUT_BITMAP_HELVETICA_18, "z")
 
+    @PROFILER.timed('draw')
     def draw(self):
         self.drawAxis()
         self.drawTexture()
+        PROFILER.overlay()
         glutSwapBuffers()
 
-    def normalize(self, pixels):
-        min, max = pixels.min(), pixels.max()
-        new_min, new_max = 0, np.iinfo(pixels.dtype).max
-        arr = (pixels - min)/(max - min)*(new_max - new_min)+new_min
-        return arr.astype(int)
+    @PROFILER.timed('get_slice')
+    def get_slice(self, plane, layer):
+        if self.loader is not None:
+            # raw modality values while loading, shown in the preview's range
+            return self.loader.preview.normalize(np.array(self.planes[plane][layer]))
+        return np.ascontiguousarray(self.planes[plane][layer])
 
+    @PROFILER.timed('drawTexture')
     def drawTexture(self):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.height, self.width, 0,
-                     GL_LUMINANCE, self.data_type, self.image_pixels[self.cor_layer])
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        # 3D and oblique views need the finished volume; until then the planes stream in
+        if self.oblique and self.loader is None:
+            self.drawOblique()
+            return
+        if self.volume_mode and self.loader is None:
+            self.drawVolume()
+            return
+        data = self.get_slice('axial', self.cor_layer)
+        self.textures.bind('axial', data, GL_LUMINANCE, self.data_type)
 
         glEnable(GL_TEXTURE_2D)
         glBegin(GL_QUADS)
@@ -104,10 +126,8 @@ class Image:
         glVertex3f(0, 1, self.cor_layer*(self.slice+self.space)/self.height)
         glEnd()
 
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.n, 0,
-                     GL_LUMINANCE, self.data_type, self.sag_pixels[self.sag_layer])
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        data = self.get_slice('sagittal', self.sag_layer)
+        self.textures.bind('sagittal', data, GL_LUMINANCE, self.data_type)
 
         glBegin(GL_QUADS)
         glTexCoord2f(0, 0)
@@ -120,10 +140,8 @@ class Image:
         glVertex3f(self.sag_layer/self.height, 0, self.n*(self.slice+self.space)/self.height)
         glEnd()
 
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.width, self.n, 0,
-                     GL_LUMINANCE, self.data_type, self.front_pixels[self.front_layer])
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        data = self.get_slice('coronal', self.front_layer)
+        self.textures.bind('coronal', data, GL_LUMINANCE, self.data_type)
 
         glBegin(GL_QUADS)
         glTexCoord2f(0, 0)
@@ -139,8 +157,75 @@ class Image:
         glDisable(GL_TEXTURE_2D)
         glFlush()
 
+    @PROFILER.timed('drawVolume')
+    def drawVolume(self):
+        # the same three planes, cut out of one 3D texture; layers are addressed at texel centres
+        self.textures.bind_volume('volume', self.image_pixels, GL_LUMINANCE, self.data_type)
+        depth, rows, cols = self.image_pixels.shape
+        top = self.n*(self.slice+self.space)/self.height
+        axial = (self.cor_layer + 0.5)/depth
+        sagittal = (self.sag_layer + 0.5)/cols
+        coronal = (self.front_layer + 0.5)/rows
+
+        glEnable(GL_TEXTURE_3D)
+        glBegin(GL_QUADS)
+        glTexCoord3f(0, 0, axial)
+        glVertex3f(0, 0, self.cor_layer*(self.slice+self.space)/self.height)
+        glTexCoord3f(1, 0, axial)
+        glVertex3f(1, 0, self.cor_layer*(self.slice+self.space)/self.height)
+        glTexCoord3f(1, 1, axial)
+        glVertex3f(1, 1, self.cor_layer*(self.slice+self.space)/self.height)
+        glTexCoord3f(0, 1, axial)
+        glVertex3f(0, 1, self.cor_layer*(self.slice+self.space)/self.height)
+        glEnd()
+
+        glBegin(GL_QUADS)
+        glTexCoord3f(sagittal, 0, 0)
+        glVertex3f(self.sag_layer/self.height, 0, 0)
+        glTexCoord3f(sagittal, 1, 0)
+        glVertex3f(self.sag_layer/self.height, 1, 0)
+        glTexCoord3f(sagittal, 1, 1)
+        glVertex3f(self.sag_layer/self.height, 1, top)
+        glTexCoord3f(sagittal, 0, 1)
+        glVertex3f(self.sag_layer/self.height, 0, top)
+        glEnd()
+
+        glBegin(GL_QUADS)
+        glTexCoord3f(0, coronal, 0)
+        glVertex3f(0, self.front_layer/self.height, 0)
+        glTexCoord3f(1, coronal, 0)
+        glVertex3f(1, self.front_layer/self.height, 0)
+        glTexCoord3f(1, coronal, 1)
+        glVertex3f(1, self.front_layer/self.height, top)
+        glTexCoord3f(0, coronal, 1)
+        glVertex3f(0, self.front_layer/self.height, top)
+        glEnd()
+
+        glDisable(GL_TEXTURE_3D)
+        glFlush()
+
+    @PROFILER.timed('drawOblique')
+    def drawOblique(self):
+        if self.reslicer is None:
+            self.reslicer = volume.Reslicer(self.image_pixels, (self.slice + self.space, 1, 1))
+        pixels, corners = self.reslicer.plane(self.theta, self.phi, self.offset)
+        self.textures.bind('oblique', pixels, GL_LUMINANCE, self.data_type)
+        depth, rows, cols = self.image_pixels.shape
+
+        # corners are pixel centres in (z, y, x), so they take the texel centres at the edges
+        s0, t0 = 0.5/pixels.shape[1], 0.5/pixels.shape[0]
+        glEnable(GL_TEXTURE_2D)
+        glBegin(GL_QUADS)
+        for (s, t), (z, y, x) in zip(((s0, t0), (1 - s0, t0), (1 - s0, 1 - t0), (s0, 1 - t0)), corners):
+            glTexCoord2f(s, t)
+            glVertex3f((x + 0.5)/cols, (y + 0.5)/rows, z/self.height)
+        glEnd()
+        glDisable(GL_TEXTURE_2D)
+        glFlush()
+
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
+        PROFILER.keyPressed(key)
         if key == "t":
             matrix = np.array([1, 0, 0, 0,
                                0, -1, 0, 0,
@@ -159,6 +244,16 @@ class Image:
             self.front_layer += 1
         elif key == "c" and self.front_layer > 0:
             self.front_layer -= 1
+        elif key == "v":
+            self.volume_mode = not self.volume_mode
+        elif key == "o":
+            self.oblique = not self.oblique
+        elif key in ("i", "k"):
+            self.theta += 5 if key == "i" else -5
+        elif key in ("j", "l"):
+            self.phi += 5 if key == "l" else -5
+        elif key in ("[", "]"):
+            self.offset += 1 if key == "]" else -1
         self.display()
 
 
@@ -173,12 +268,13 @@ def main():
     glutInit()
     glutInitDisplayMode(GLUT_DOUBLE | GLUT_RGB)
     path ="Data-Pract/Lab#7 - DICOM_set_16bits"
-    image = Image(path)
+    image = Image(path, progressive=True)
     initWindow(image.width*2, image.height*2)
     image.init()
 
     glutDisplayFunc(image.display)
     glutKeyboardFunc(image.keyPressed)
+    glutTimerFunc(100, image.poll, 0)
     glutMainLoop()
 
 
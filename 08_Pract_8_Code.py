@@ -2,79 +2,132 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 import numpy as np
-import dicom
+import dicom_io
 from os.path import join
+import texture
+from profiler import PROFILER
 
 
 class Image:
-    def __init__(self, path):
-        ds_ct = dicom.read_file(join(path, "2-ct.dcm"))
-        ds_mri = dicom.read_file(join(path, "2-mri.dcm"))
+    def __init__(self, path, npot=False, ct_name="2-ct.dcm", mri_name="2-mri.dcm"):
+        ds_ct, ct = dicom_io.read_file(join(path, ct_name))
+        ds_mri, mri = dicom_io.read_file(join(path, mri_name))
 
         self.data_type = self.image_type(ds_ct)
         self.height, self.width = ds_mri[0x280010].value, ds_mri[0x280011].value
-        self.d_height, self.d_width = 512, 256
-        self.ct_pixels = np.zeros((self.d_height, self.d_width))
-        self.mri_pixels = np.zeros((self.d_height, self.d_width))
+        self.npot = npot
+        self.ct_pixels, self.extent = self.pad(ct)
+        self.mri_pixels, _ = self.pad(mri)
+        self.d_height, self.d_width = self.ct_pixels.shape
 
-        for i in range(self.height):
-            for j in range(self.width):
-                self.ct_pixels[i][j] = ds_ct.pixel_array[i][j]
-                self.mri_pixels[i][j] = ds_mri.pixel_array[i][j]
+        self.mask = self.interleave_mask()
+        self.mode, self.alpha = 'd', 0.5
+        self.fused = {}
+        self.textures = texture.TextureManager()
 
     def image_type(self, ds):
             return GL_UNSIGNED_BYTE if ds[0x280100].value == 8 else GL_UNSIGNED_SHORT
 
+    def texture_shape(self):
+        if self.npot:
+            return self.height, self.width
+        return tuple(1 << (size - 1).bit_length() for size in (self.height, self.width))
+
+    def pad(self, pixels):
+        d_height, d_width = self.texture_shape()
+        padded = np.zeros((d_height, d_width), dtype=pixels.dtype)
+        part = pixels[:self.height, :self.width]
+        padded[:part.shape[0], :part.shape[1]] = part
+        return padded, (self.width/d_width, self.height/d_height)
+
     def init(self):
         glClearColor(0, 0, 0, 0.0)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
         gluOrtho2D(0.0, 1.0, 0.0, 1.0)
 
+    def interleave_mask(self):
+        # lower half of the image, alternating pixel by pixel in row-major order
+        rows, cols = np.indices((self.d_height, self.d_width))
+        mask = ((rows - self.height//2)*self.width + cols) % 2 == 1
+        mask &= (rows >= self.height//2) & (rows < self.height) & (cols < self.width)
+        return mask
+
     def doubled(self, first, second):
-        result = np.copy(first)
-        c = 1
-        for i in range(self.height//2, self.height):
-            for j in range(self.width):
-                result[i][j] = second[i, j] if c == 2 else first[i, j]
-                if c == 1:
-                    c = 2
-                else:
-                    c = 1
-        return result
-
-    def display(self, key='d'):
+        return np.where(self.mask, second, first)
+
+    def blend(self, first, second, alpha):
+        # (1 - alpha)*first + alpha*second as first + alpha*(second - first), in one float32 buffer
+        result = np.subtract(second, first, dtype=np.float32)
+        result *= np.float32(alpha)
+        np.add(result, first, out=result, dtype=np.float32)
+        if first.dtype.kind in 'ui':
+            info = np.iinfo(first.dtype)
+            np.clip(result, info.min, info.max, out=result)
+            np.rint(result, out=result)
+        return result.astype(first.dtype)
+
+    def overlay(self, first, second):
+        rgb = np.empty(first.shape + (3,), dtype=first.dtype)
+        rgb[..., 0] = second
+        rgb[..., 1] = first
+        rgb[..., 2] = first
+        return rgb
+
+    @PROFILER.timed('fuse')
+    def fuse(self, mode, alpha=0.5):
+        key = (mode, alpha) if mode == 'a' else (mode,)
+        if key not in self.fused:
+            if mode == 'c':
+                result = self.ct_pixels
+            elif mode == 'm':
+                result = self.mri_pixels
+            elif mode == 'd':
+                result = self.doubled(self.ct_pixels, self.mri_pixels)
+            elif mode == 'a':
+                result = self.blend(self.ct_pixels, self.mri_pixels, alpha)
+            elif mode == 'o':
+                result = self.overlay(self.ct_pixels, self.mri_pixels)
+            self.fused[key] = result
+        return self.fused[key]
+
+    @PROFILER.timed('display')
+    def display(self):
         glClear(GL_COLOR_BUFFER_BIT)
-        if key == 'c':
-            pixels_to_draw = self.ct_pixels
-        elif key == 'm':
-            pixels_to_draw = self.mri_pixels
-        elif key == 'd':
-            pixels_to_draw = self.doubled(self.ct_pixels, self.mri_pixels)
-        self.drawTexture(pixels_to_draw)
+        self.textures.begin_frame()
+        pixels_to_draw = self.fuse(self.mode, self.alpha)
+        self.drawTexture(pixels_to_draw, GL_RGB if self.mode == 'o' else GL_LUMINANCE)
+        PROFILER.overlay()
         glutSwapBuffers()
 
-    def drawTexture(self, data):
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self.d_width, self.d_height, 0, GL_LUMINANCE, self.data_type, data)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    @PROFILER.timed('drawTexture')
+    def drawTexture(self, data, format_=GL_LUMINANCE):
+        self.textures.bind('image', data, format_, self.data_type)
 
+        s, t = self.extent
         glEnable(GL_TEXTURE_2D)
         glBegin(GL_QUADS)
         glTexCoord2d(0.0, 0.0)
         glVertex2d(0, 0)
-        glTexCoord2d(self.width/self.d_width, 0.0)
+        glTexCoord2d(s, 0.0)
         glVertex2d(1.0, 0)
-        glTexCoord2d(self.width/self.d_width, self.height/self.d_height)
+        glTexCoord2d(s, t)
         glVertex2d(1.0, 1.0)
-        glTexCoord2d(0.0, self.height/self.d_height)
+        glTexCoord2d(0.0, t)
         glVertex2d(0.0, 1.0)
         glEnd()
         glDisable(GL_TEXTURE_2D)
 
     def keyPressed(self, bkey, x, y):
         key = unicode(bkey, errors='ignore')
-        self.display(key)
+        PROFILER.keyPressed(key)
+        if key in ('c', 'm', 'd', 'a', 'o'):
+            self.mode = key
+        elif key == '+':
+            self.alpha = round(min(self.alpha + 0.1, 1), 1)
+        elif key == '-':
+            self.alpha = round(max(self.alpha - 0.1, 0), 1)
+        self.display()
 
 
 def initWindow(width, height):
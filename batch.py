@@ -0,0 +1,210 @@
+import argparse
+import csv
+import fnmatch
+import importlib
+import os
+import struct
+import time
+import traceback
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import dicom_io
+import lut
+
+
+def practical(number):
+    return importlib.import_module('08_Pract_%d_Code' % number)
+
+
+class Study:
+    def __init__(self, name, reference=None):
+        self.name = name
+        self.reference = reference
+        self.images = {}
+
+    def image(self, number):
+        if number not in self.images:
+            if number == 8:
+                if self.reference is None:
+                    raise ValueError('fusion needs --reference')
+                image = practical(8).Image(os.path.dirname(self.name), npot=True,
+                                           ct_name=os.path.basename(self.name), mri_name=self.reference)
+            else:
+                image = practical(number).Image(self.name)
+            self.images[number] = image
+        return self.images[number]
+
+    def pixels(self):
+        return self.image(2).image_pixels
+
+
+def contour(study, pixels):
+    points = np.rint(study.image(5).activation_border()).astype(int)
+    rows, cols = points[:, 0], points[:, 1]
+    inside = (rows >= 0) & (rows < pixels.shape[0]) & (cols >= 0) & (cols < pixels.shape[1])
+    result = np.copy(pixels)
+    result[rows[inside], cols[inside]] = lut.white(pixels.dtype)
+    return result
+
+
+def fusion(mode):
+    # fusion always starts from the raw study and reference pair
+    return lambda study, pixels: study.image(8).fuse(mode)
+
+
+FUSIONS = ('interleave', 'blend', 'overlay')
+
+
+OPERATIONS = {
+    'normalize': lambda study, pixels: study.image(2).make_normalization(pixels, 0.7, 1),
+    'invert': lambda study, pixels: study.image(2).make_inversion(pixels),
+    'sobel': lambda study, pixels: study.image(3).filtration(pixels),
+    'threshold': lambda study, pixels: study.image(4).segment(pixels),
+    'contour': contour,
+    'interleave': fusion('d'),
+    'blend': fusion('a'),
+    'overlay': fusion('o'),
+}
+
+
+# consecutive geometric steps compose into one matrix and cost a single resample
+GEOMETRY = {'mirror': 1, 'scale': 2, 'rotate': 1}
+
+
+def geometry(study, steps):
+    image = study.image(6)
+    matrix = np.eye(4)
+    for name, args in steps:
+        matrix = matrix @ np.transpose(getattr(image, name)(*args))
+    return matrix
+
+
+def parse(operation):
+    name, *args = operation.split(':')
+    return name, [float(arg) for arg in args]
+
+
+def known(operation):
+    if operation in OPERATIONS:
+        return True
+    try:
+        name, args = parse(operation)
+    except ValueError:
+        return False
+    return GEOMETRY.get(name) == len(args)
+
+
+def write_png(name, pixels):
+    pixels = np.ascontiguousarray(pixels)
+    height, width = pixels.shape[:2]
+    color = 2 if pixels.ndim == 3 else 0
+    depth = pixels.dtype.itemsize*8
+    if depth not in (8, 16):
+        pixels = (pixels >> (depth - 16)).astype(np.uint16)
+        depth = 16
+    data = pixels.astype(pixels.dtype.newbyteorder('>')).view(np.uint8).reshape(height, -1)
+    rows = np.zeros((height, data.shape[1] + 1), dtype=np.uint8)
+    rows[:, 1:] = data
+
+    def chunk(tag, body):
+        return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', zlib.crc32(tag + body) & 0xffffffff)
+
+    with open(name, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth, color, 0, 0, 0)))
+        fp.write(chunk(b'IDAT', zlib.compress(rows.tobytes())))
+        fp.write(chunk(b'IEND', b''))
+
+
+def write(name, study, pixels, format_):
+    if format_ != 'npy' and pixels.dtype.kind == 'f':
+        pixels = np.rint(np.clip(pixels, 0, 1)*65535).astype(np.uint16)
+    if format_ == 'npy':
+        np.save(name, pixels)
+    elif format_ == 'png':
+        write_png(name, pixels)
+    else:
+        dicom_io.write_file(name, dicom_io.read_header(study.name), pixels)
+
+
+def process_file(name, root, output, operations, format_, reference, order=1):
+    start = time.perf_counter()
+    target = os.path.join(output, os.path.splitext(os.path.relpath(name, root))[0] + '.' + format_)
+    try:
+        study = Study(name, reference)
+        pixels = None if operations[0] in FUSIONS else study.pixels()
+        steps = []
+        for operation in operations + [None]:
+            step = parse(operation) if operation else None
+            if step and step[0] in GEOMETRY:
+                steps.append(step)
+                continue
+            if steps:
+                pixels = study.image(6).resample(pixels, geometry(study, steps), order)
+                steps = []
+            if operation:
+                pixels = OPERATIONS[operation](study, pixels)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        write(target, study, pixels, format_)
+        error = ''
+    except Exception:
+        target, error = '', traceback.format_exc().strip().splitlines()[-1]
+    return name, target, time.perf_counter() - start, error
+
+
+def find_files(root, pattern):
+    for path, _, names in os.walk(root):
+        for name in sorted(fnmatch.filter(names, pattern)):
+            yield os.path.join(path, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the practical operations over a tree of DICOM files.')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--ops', default='normalize',
+                        help='comma-separated pipeline of: ' + ', '.join(OPERATIONS) +
+                             ', mirror:X, scale:SX:SY, rotate:DEGREES')
+    parser.add_argument('--order', type=int, default=1, help='interpolation order of geometric steps')
+    parser.add_argument('--format', choices=('dcm', 'png', 'npy'), default='npy')
+    parser.add_argument('--pattern', default='*.dcm')
+    parser.add_argument('--reference', help='second modality for interleave, blend and overlay')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    operations = [operation for operation in args.ops.split(',') if operation]
+    if not operations:
+        parser.error('empty pipeline')
+    unknown = [operation for operation in operations if not known(operation)]
+    if unknown:
+        parser.error('unknown operations: ' + ', '.join(unknown))
+    misplaced = [operation for operation in operations[1:] if operation in FUSIONS]
+    if misplaced:
+        # fusion reads the raw pair, so anything before it would be dropped
+        parser.error('fusion must be the first step: ' + ', '.join(misplaced))
+    reference = os.path.abspath(args.reference) if args.reference else None
+    files = list(find_files(args.input, args.pattern))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(process_file, name, args.input, args.output, operations, args.format, reference,
+                               args.order)
+                   for name in files]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'summary.csv'), 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['input', 'output', 'seconds', 'error'])
+        for name, target, seconds, error in results:
+            writer.writerow([name, target, '%.4f' % seconds, error])
+
+    failed = sum(1 for result in results if result[3])
+    print('%d files, %d failed, %.2f s' % (len(results), failed, elapsed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,165 @@
+import argparse
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import dicom_io
+import lut
+from batch import practical
+
+SINGLE = "Data-Pract/Lab#2-#6 - DICOM_single_16bits/DICOM_Image_16b.dcm"
+SERIES = "Data-Pract/Lab#7 - DICOM_set_16bits/brain_001.dcm"
+
+
+def phantom(height, width, seed=0):
+    # two nested ellipses over a dark, clipped background: the histogram peaks at the
+    # lowest intensity, which is the shape the triangle threshold expects
+    rows, cols = np.ogrid[-1:1:height*1j, -1:1:width*1j]
+    radius = rows**2 + (cols/0.8)**2
+    pixels = np.random.default_rng(seed).normal(0, 40, (height, width))
+    pixels += 1500*(radius < 0.6) + 1000*(radius < 0.2)
+    return np.clip(pixels, 0, 4095).astype(np.uint16)
+
+
+def write_single(path, size):
+    name = os.path.join(path, 'single_%d.dcm' % size)
+    dicom_io.write_file(name, dicom_io.read_header(SINGLE), phantom(size, size))
+    return name
+
+
+def write_series(path, slices, size=256):
+    folder = os.path.join(path, 'series_%d' % slices)
+    os.makedirs(folder)
+    for index in range(slices):
+        ds = dicom_io.read_header(SERIES)
+        ds[0x200013].value = index + 1
+        dicom_io.write_file(os.path.join(folder, '%05d.dcm' % index), ds, phantom(size, size, index))
+    return folder
+
+
+def single_benchmarks(name, workdir):
+    raw = np.array(dicom_io.read_file(name)[1])
+    first, second, third = practical(1).Image(name), practical(2).Image(name), practical(3).Image(name)
+    fourth, fifth = practical(4).Image(name), practical(5).Image(name)
+    eighth = practical(8).Image(os.path.dirname(name), npot=True,
+                                ct_name=os.path.basename(name), mri_name=os.path.basename(name))
+    pixels = second.image_pixels
+
+    def make_filtration():
+        fourth.hist_cache = fourth.mask_cache = None
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            fourth.export(pixels)
+        finally:
+            os.chdir(cwd)
+
+    def active_contour():
+        fifth.fields.clear()
+        fifth.contours.clear()
+        fifth.activation_border()
+
+    megapixels = pixels.size/1e6
+    return {
+        'normalize': (lambda: lut.normalize(raw), megapixels),
+        'transform_gradient': (lambda: first.transform_gradient(pixels), megapixels),
+        'make_normalization': (lambda: second.make_normalization(pixels, 0.7, 1), megapixels),
+        'make_inversion': (lambda: second.make_inversion(pixels), megapixels),
+        'filtration': (lambda: third.filtration(pixels), megapixels),
+        'make_filtration': (make_filtration, megapixels),
+        'active_contour': (active_contour, megapixels),
+        'doubled': (lambda: eighth.doubled(eighth.ct_pixels, eighth.mri_pixels), megapixels),
+    }
+
+
+def series_benchmarks(folder):
+    image = practical(7).Image(folder)
+
+    def reslice():
+        image.get_slice('coronal', image.height//2)
+        image.get_slice('sagittal', image.width//2)
+
+    depth, height, width = image.image_pixels.shape
+    return {
+        'load_series': (lambda: practical(7).Image(folder), image.image_pixels.size/1e6),
+        'reslice': (reslice, depth*(height + width)/1e6),
+    }
+
+
+def measure(run, megapixels, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min(times)
+    return {'seconds': best, 'mpps': megapixels/best, 'peak_mb': peak/2**20}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        result['ratio'] = result['mpps']/baseline[key]['mpps']
+        slower = result['ratio'] < 1 - tolerance
+        # a little slack so tiny peaks do not flag on allocator noise
+        larger = result['peak_mb'] > baseline[key]['peak_mb']*(1 + tolerance) + 1
+        if slower or larger:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and peak memory of the practical operations.')
+    parser.add_argument('--sizes', default='256,512,1024,2048,4096')
+    parser.add_argument('--slices', default='20,200,2000')
+    parser.add_argument('--only', help='comma-separated benchmark names')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', help='json file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--save', help='write the results as a new baseline')
+    args = parser.parse_args()
+    only = set(args.only.split(',')) if args.only else None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        sizes = [int(size) for size in args.sizes.split(',') if size]
+        slices = [int(count) for count in args.slices.split(',') if count]
+        jobs = [(size, lambda size=size: single_benchmarks(write_single(workdir, size), workdir))
+                for size in sizes]
+        jobs += [(count, lambda count=count: series_benchmarks(write_series(workdir, count)))
+                 for count in slices]
+        for size, suite in jobs:
+            for name, (run, megapixels) in suite().items():
+                if only and name not in only:
+                    continue
+                key = '%s@%d' % (name, size)
+                results[key] = measure(run, megapixels, args.repeat)
+                print('%-28s %10.2f MP/s %10.1f MB peak' % (key, results[key]['mpps'], results[key]['peak_mb']))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.tolerance)
+        for key in regressions:
+            print('regression: %s at %.0f%% of baseline throughput, %.1f MB peak (was %.1f)'
+                  % (key, 100*results[key]['ratio'], results[key]['peak_mb'], baseline[key]['peak_mb']))
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
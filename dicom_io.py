@@ -0,0 +1,185 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import dicom
+import lut
+from profiler import PROFILER
+
+UNCOMPRESSED = {'1.2.840.10008.1.2': '<', '1.2.840.10008.1.2.1': '<', '1.2.840.10008.1.2.2': '>'}
+PIXEL_DATA = {'<': b'\xe0\x7f\x10\x00', '>': b'\x7f\xe0\x00\x10'}
+
+
+def read_header(name):
+    return dicom.read_file(name, stop_before_pixels=True)
+
+
+def pixel_dtype(ds):
+    sign = 'int' if ds[0x280103].value else 'uint'
+    return np.dtype('%s%d' % (sign, ds[0x280100].value))
+
+
+@PROFILER.timed('decode')
+def read_file(name):
+    with open(name, 'rb') as fp:
+        ds = dicom.read_file(fp, stop_before_pixels=True)
+        offset = fp.tell()
+        element = fp.read(12)
+
+    syntax = ds.file_meta.TransferSyntaxUID
+    byteorder = UNCOMPRESSED.get(syntax)
+    planar = 0x280006 in ds and ds[0x280006].value == 1
+    if byteorder is None or planar or ds[0x280100].value not in (8, 16, 32) or element[:4] != PIXEL_DATA[byteorder]:
+        return ds, dicom.read_file(name).pixel_array
+
+    # implicit VR: tag and a 4-byte length; explicit VR: tag, VR, two reserved bytes and a 4-byte length
+    offset += 8 if syntax == '1.2.840.10008.1.2' else 12
+    shape = (ds[0x280010].value, ds[0x280011].value)
+    if 0x280008 in ds and int(ds[0x280008].value) > 1:
+        shape = (int(ds[0x280008].value),) + shape
+    if ds[0x280002].value > 1:
+        shape += (ds[0x280002].value,)
+    dtype = pixel_dtype(ds).newbyteorder(byteorder)
+    return ds, np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def rescale(ds):
+    slope = ds[0x281053].value if 0x281053 in ds else 1
+    intercept = ds[0x281052].value if 0x281052 in ds else 0
+    return float(slope), float(intercept)
+
+
+def stored_range(ds):
+    bits = ds[0x280101].value
+    if ds[0x280103].value:
+        return -(1 << bits - 1), (1 << bits - 1) - 1
+    return 0, (1 << bits) - 1
+
+
+def modality_dtype(ds):
+    return lut.modality_dtype(pixel_dtype(ds), *stored_range(ds), *rescale(ds))
+
+
+def modality_range(ds):
+    slope, intercept = rescale(ds)
+    ends = sorted(slope*value + intercept for value in stored_range(ds))
+    if modality_dtype(ds).kind in 'ui':
+        return int(ends[0]), int(ends[1])
+    return ends[0], ends[1]
+
+
+def slice_order(headers):
+    if all(0x200013 in ds for ds in headers):
+        keys = [int(ds[0x200013].value) for ds in headers]
+    elif all(0x200032 in ds for ds in headers):
+        keys = [float(ds[0x200032].value[2]) for ds in headers]
+    else:
+        keys = list(range(len(headers)))
+    return sorted(range(len(headers)), key=lambda i: (keys[i], i))
+
+
+def series_files(path, pool):
+    files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    headers = list(pool.map(read_header, files))
+    order = slice_order(headers)
+    return [files[i] for i in order], headers[order[0]]
+
+
+@PROFILER.timed('load_volume')
+def load_volume(path, workers=None):
+    # modality values go straight into the volume while the statistics stream in beside them;
+    # the caller rescales the whole volume once with stats.normalize
+    with ThreadPoolExecutor(workers) as pool:
+        files, ds = series_files(path, pool)
+        slope, intercept = rescale(ds)
+        modality = modality_dtype(ds)
+        stats = lut.Statistics(*modality_range(ds), modality)
+        volume = np.empty((len(files), ds[0x280010].value, ds[0x280011].value), dtype=modality)
+
+        def load(index):
+            pixels = lut.modality(read_file(files[index])[1], slope, intercept, modality)
+            volume[index] = pixels
+            stats.add(volume[index])
+
+        list(pool.map(load, range(len(files))))
+    return volume, ds, stats
+
+
+class SeriesLoader:
+    # only the first file is read up front; a background thread orders the series, decodes
+    # a strided preview upsampled into the volume, overwrites it with full-resolution
+    # slices and finally publishes a normalized copy
+    def __init__(self, path, step=4, workers=None):
+        self.path = path
+        self.step = step
+        self.pool = ThreadPoolExecutor(workers)
+        names = sorted(os.listdir(path))
+        self.ds, first = read_file(os.path.join(path, names[0]))
+        self.slope, self.intercept = rescale(self.ds)
+        self.modality = modality_dtype(self.ds)
+        self.volume = np.zeros((len(names), self.ds[0x280010].value, self.ds[0x280011].value),
+                               dtype=self.modality)
+        self.preview = lut.Statistics(*modality_range(self.ds), self.modality)
+        self.stats = lut.Statistics(*modality_range(self.ds), self.modality)
+        # the first file sets the display range until the preview slices come in
+        self.preview.add(lut.modality(first, self.slope, self.intercept, self.modality))
+        self.files = None
+        self.pixels = None
+        self.error = None
+        self.loaded = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def decode(self, index, step=1):
+        pixels = read_file(self.files[index])[1][::step, ::step]
+        return lut.modality(pixels, self.slope, self.intercept, self.modality)
+
+    def coarse(self, index):
+        pixels = self.decode(index, self.step)
+        self.preview.add(pixels)
+        rows, cols = self.volume.shape[1:]
+        block = np.repeat(np.repeat(pixels, self.step, 0), self.step, 1)[:rows, :cols]
+        self.volume[index:index + self.step] = block
+
+    def full(self, index):
+        self.volume[index] = self.decode(index)
+        self.stats.add(self.volume[index])
+
+    @PROFILER.timed('load_series')
+    def run(self):
+        try:
+            self.files = series_files(self.path, self.pool)[0]
+            for _ in self.pool.map(self.coarse, range(0, len(self.files), self.step)):
+                self.loaded += 1
+            for _ in self.pool.map(self.full, range(len(self.files))):
+                self.loaded += 1
+            # the viewer keeps reading the raw volume until it swaps, so it is never rewritten
+            self.pixels = self.stats.normalize(self.volume, np.empty(self.volume.shape,
+                                                                     lut.unsigned(self.modality)))
+        except Exception as error:
+            self.error = error
+        finally:
+            self.pool.shutdown()
+            self.done.set()
+
+
+def write_file(name, ds, pixels):
+    pixels = np.ascontiguousarray(pixels)
+    bits = pixels.dtype.itemsize*8
+    ds.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.Rows, ds.Columns = pixels.shape[:2]
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = bits, bits, bits - 1
+    ds.PixelRepresentation = int(pixels.dtype.kind == 'i')
+    # the pixels are already processed values: the source's modality and VOI stages must not run again
+    for tag in (0x281050, 0x281051, 0x281055, 0x283000, 0x283010, 0x281052, 0x281053, 0x281054):
+        if tag in ds:
+            del ds[tag]
+    if pixels.ndim == 3:
+        ds.SamplesPerPixel, ds.PhotometricInterpretation, ds.PlanarConfiguration = 3, 'RGB', 0
+    else:
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+        ds.RescaleIntercept, ds.RescaleSlope = 0, 1
+    ds.add_new(0x7fe00010, 'OB' if bits == 8 else 'OW', pixels.astype(pixels.dtype.newbyteorder('<')).tobytes())
+    ds.save_as(name)
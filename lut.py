@@ -0,0 +1,159 @@
+import threading
+import numpy as np
+
+
+def identity(size, dtype=np.int64):
+    return np.arange(size, dtype=dtype)
+
+
+def gradient(size):
+    # walks down from the top intensity: +2 per level above 127, -2 below
+    keys = np.arange(size - 1, -1, -1)
+    steps = np.where(keys >= 127, 2, -2)
+    table = np.empty(size, dtype=np.int64)
+    table[keys] = np.cumsum(steps) - steps
+    return table
+
+
+def rescale(values, lo, hi, p_min, p_max):
+    p_min, p_max = p_min*hi, p_max*hi
+    return p_min + (values - lo)/(hi - lo)*(p_max - p_min)
+
+
+def normalization(lo, hi, p_min, p_max, size, dtype=np.int64):
+    return rescale(identity(size, np.float32), lo, hi, p_min, p_max).astype(dtype)
+
+
+def inversion(lo, hi, size, dtype=np.int64):
+    return hi - identity(size, dtype) + lo
+
+
+def window(center, width, out_max, size, dtype=np.int64):
+    scaled = (identity(size, np.float32) - (center - 0.5))/(width - 1) + 0.5
+    return (np.clip(scaled, 0, 1)*out_max).astype(dtype)
+
+
+def compose(*tables):
+    result = tables[0]
+    for table in tables[1:]:
+        result = table[np.clip(result, 0, len(table) - 1)]
+    return result
+
+
+def apply(table, pixels, out=None):
+    return np.take(table, pixels, out=out)
+
+
+def white(dtype):
+    dtype = np.dtype(dtype)
+    return np.iinfo(dtype).max if dtype.kind in 'ui' else 1.0
+
+
+def modality_dtype(dtype, lo, hi, slope, intercept):
+    # integral rescales stay integers of the stored width when the output range fits
+    ends = (slope*lo + intercept, slope*hi + intercept)
+    if float(slope).is_integer() and float(intercept).is_integer():
+        for candidate in (dtype, np.dtype('int%d' % (8*dtype.itemsize))):
+            info = np.iinfo(candidate)
+            if info.min <= min(ends) and max(ends) <= info.max:
+                return candidate
+    return np.dtype(np.float32)
+
+
+def modality(pixels, slope, intercept, dtype=None):
+    if slope == 1 and intercept == 0 and dtype in (None, pixels.dtype):
+        return pixels
+    lo, hi = int(pixels.min()), int(pixels.max())
+    if dtype is None:
+        dtype = modality_dtype(pixels.dtype, lo, hi, slope, intercept)
+    if dtype.kind in 'ui' and lo >= 0 and hi < 1 << 16:
+        table = (int(slope)*identity(hi + 1) + int(intercept)).astype(dtype)
+        return apply(table, pixels)
+    out = pixels.astype(dtype)
+    out *= dtype.type(slope)
+    out += dtype.type(intercept)
+    return out
+
+
+def unsigned(dtype):
+    # what normalization hands back: floats keep their type, integers go to the unsigned one of their width
+    dtype = np.dtype(dtype)
+    return dtype if dtype.kind == 'f' else np.dtype('uint%d' % (8*dtype.itemsize))
+
+
+def normalize(pixels, min=None, max=None, out=None):
+    # integers map onto the full unsigned range of their width, floats onto [0, 1]
+    if min is None:
+        min, max = pixels.min(), pixels.max()
+    if pixels.dtype.kind == 'f':
+        # float32 comes out of the modality stage as our own buffer: by default map it in place
+        out = pixels if out is None else out
+        np.subtract(pixels, min, out=out)
+        out /= max - min
+        return out
+    dtype = unsigned(pixels.dtype)
+    if out is None:
+        out = np.empty(pixels.shape, dtype=dtype)
+    min, max = int(min), int(max)
+    scale = np.float64(white(dtype))/(max - min)
+    # plane by plane, so no temporary grows past one slice; out may alias pixels
+    planes = zip(pixels.reshape(-1, *pixels.shape[-2:]), out.reshape(-1, *out.shape[-2:]))
+    if pixels.dtype.itemsize <= 2:
+        # a table over every bit pattern of the stored type, indexed through the unsigned view
+        values = identity(1 << 8*pixels.dtype.itemsize, dtype).view(pixels.dtype)
+        table = np.subtract(values, min, dtype=np.float32)
+        table *= scale
+        np.clip(np.rint(table, out=table), 0, white(dtype), out=table)
+        table = table.astype(dtype)
+        for plane, target in planes:
+            np.take(table, plane.view(dtype), out=target, mode='clip')
+        return out
+    for plane, target in planes:
+        arr = np.subtract(plane, min, dtype=np.float32)
+        arr *= scale
+        target[...] = np.rint(arr, out=arr)
+    return out
+
+
+class Statistics:
+    # running min/max and histogram over a value range known up front, fed one slice at a time
+    def __init__(self, lo, hi, dtype, bins=1 << 16):
+        self.lo, self.hi, self.dtype = lo, hi, np.dtype(dtype)
+        levels = hi - lo + 1
+        if self.dtype.kind in 'ui' and levels <= bins:
+            # integers of up to 16 bits get one bin per level
+            self.bins, self.step = levels, 1
+        else:
+            self.bins, self.step = bins, (hi - lo)/bins
+        self.hist = np.zeros(self.bins, dtype=np.int64)
+        self.min, self.max = np.inf, -np.inf
+        self.lock = threading.Lock()
+
+    def add(self, pixels):
+        lo, hi = pixels.min().item(), pixels.max().item()
+        if self.step == 1:
+            # values outside the stored range (BitsStored smaller than the data) land in the end bins
+            if lo < self.lo or hi > self.hi:
+                pixels = np.clip(pixels, self.lo, self.hi)
+            if self.lo:
+                pixels = np.subtract(pixels, self.lo, dtype=np.intp)
+            hist = np.bincount(pixels.ravel(), minlength=self.bins)
+        else:
+            hist = np.histogram(pixels, self.bins, (self.lo, self.hi))[0]
+        with self.lock:
+            self.hist += hist
+            self.min, self.max = min(self.min, lo), max(self.max, hi)
+
+    def count(self):
+        return int(self.hist.sum())
+
+    def percentile(self, q):
+        cumulative = np.cumsum(self.hist)
+        index = int(np.searchsorted(cumulative, q/100*cumulative[-1]))
+        return self.lo + index*self.step
+
+    def normalize(self, volume, out=None):
+        # one pass over the whole volume, by default written back into its own buffer
+        if out is None:
+            out = volume.view(unsigned(volume.dtype))
+        return normalize(volume, self.min, self.max, out)
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+from OpenGL.GL import *
+from OpenGL.GLUT import *
+
+
+class Profiler:
+    def __init__(self, size=4096):
+        # set PROFILE=1 to also capture start-up decoding
+        self.enabled = bool(os.environ.get('PROFILE'))
+        self.events = deque(maxlen=size)
+
+    def timed(self, name):
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.events.append((name, start, time.perf_counter() - start, threading.get_ident()))
+            # wraps does not carry lru_cache's counters over
+            for attribute in ('cache_info', 'cache_clear'):
+                if hasattr(function, attribute):
+                    setattr(wrapper, attribute, getattr(function, attribute))
+            return wrapper
+        return decorate
+
+    def fps(self, name='display', window=1.0):
+        starts = [start for event, start, _, _ in self.events if event == name]
+        recent = [start for start in starts if start >= time.perf_counter() - window]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1)/(recent[-1] - recent[0])
+
+    def stages(self, last=60):
+        stages = {}
+        for name, _, duration, _ in self.events:
+            stages.setdefault(name, deque(maxlen=last)).append(duration)
+        return {name: sum(durations)/len(durations) for name, durations in stages.items()}
+
+    def printText(self, x, y, font, text):
+        glColor3f(1, 1, 1)
+        glWindowPos2i(x, y)
+        for c in text:
+            glutBitmapCharacter(font, ctypes.c_int(ord(c)))
+
+    def overlay(self):
+        if not self.enabled:
+            return
+        height = glutGet(GLUT_WINDOW_HEIGHT)
+        lines = ['fps %.1f' % self.fps()]
+        lines += ['%s %.2f ms' % (name, 1000*duration) for name, duration in sorted(self.stages().items())]
+        glPushAttrib(GL_CURRENT_BIT)
+        for i, text in enumerate(lines):
+            self.printText(10, height - 20*(i + 1), GLUT_BITMAP_9_BY_15, text)
+        glPopAttrib()
+
+    def dump(self, name='trace.json'):
+        pid = os.getpid()
+        events = [{'name': event, 'ph': 'X', 'ts': start*1e6, 'dur': duration*1e6, 'pid': pid, 'tid': tid}
+                  for event, start, duration, tid in self.events]
+        with open(name, 'w') as fp:
+            json.dump({'traceEvents': events}, fp)
+
+    def keyPressed(self, key):
+        if key == 'P':
+            self.enabled = not self.enabled
+        if key == 'T':
+            self.dump()
+
+
+PROFILER = Profiler()
@@ -0,0 +1,192 @@
+from OpenGL.GL import *
+from collections import OrderedDict
+import threading
+import numpy as np
+from profiler import PROFILER
+
+COMPONENTS = {GL_LUMINANCE: 1, GL_RGB: 3, GL_RGBA: 4}
+TYPE_SIZES = {GL_UNSIGNED_BYTE: 1, GL_BYTE: 1, GL_UNSIGNED_SHORT: 2, GL_SHORT: 2,
+              GL_UNSIGNED_INT: 4, GL_INT: 4, GL_FLOAT: 4}
+GL_TYPES = {'uint8': GL_UNSIGNED_BYTE, 'int8': GL_BYTE, 'uint16': GL_UNSIGNED_SHORT, 'int16': GL_SHORT,
+            'uint32': GL_UNSIGNED_INT, 'int32': GL_INT, 'float32': GL_FLOAT}
+
+
+def gl_type(dtype):
+    return GL_TYPES[np.dtype(dtype).name]
+
+
+QUADS = {}
+
+
+def quad(width, height):
+    # the textured quad never changes, so it is compiled once per size and replayed
+    if (width, height) not in QUADS:
+        QUADS[width, height] = glGenLists(1)
+        glNewList(QUADS[width, height], GL_COMPILE)
+        glEnable(GL_TEXTURE_2D)
+        glBegin(GL_QUADS)
+        glTexCoord2d(0.0, 0.0)
+        glVertex2d(0.0, 0.0)
+        glTexCoord2d(1.0, 0.0)
+        glVertex2d(width, 0.0)
+        glTexCoord2d(1.0, 1.0)
+        glVertex2d(width, height)
+        glTexCoord2d(0.0, 1.0)
+        glVertex2d(0.0, height)
+        glEnd()
+        glDisable(GL_TEXTURE_2D)
+        glEndList()
+    return QUADS[width, height]
+
+
+class TextureManager:
+    def __init__(self):
+        self.textures = {}
+        self.frame_bytes = 0
+        self.total_bytes = 0
+
+    def begin_frame(self):
+        self.frame_bytes = 0
+
+    def count(self, width, height, format_, type_):
+        size = width * height * COMPONENTS[format_] * TYPE_SIZES[type_]
+        self.frame_bytes += size
+        self.total_bytes += size
+
+    @PROFILER.timed('upload')
+    def bind(self, key, data, format_=GL_LUMINANCE, type_=GL_UNSIGNED_BYTE):
+        height, width = data.shape[:2]
+        texture = self.textures.get(key)
+        if texture is None:
+            texture = self.textures[key] = {'id': glGenTextures(1), 'data': None}
+        glBindTexture(GL_TEXTURE_2D, texture['id'])
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+
+        if texture['data'] is None or (texture['data'].shape, texture['format'], texture['type']) != \
+                (data.shape, format_, type_):
+            glTexImage2D(GL_TEXTURE_2D, 0, format_, width, height, 0, format_, type_, data)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            self.count(width, height, format_, type_)
+        elif data is not texture['data']:
+            # callers hand over a new array whenever the pixels change, so the
+            # same object means the resident texture is still up to date
+            self.update(data, texture['data'], format_, type_)
+
+        texture.update(data=data, format=format_, type=type_)
+        return texture['id']
+
+    @PROFILER.timed('upload')
+    def bind_volume(self, key, data, format_=GL_LUMINANCE, type_=GL_UNSIGNED_BYTE):
+        # the whole volume goes up once; afterwards binding only selects it
+        depth, height, width = data.shape[:3]
+        texture = self.textures.get(key)
+        if texture is None:
+            texture = self.textures[key] = {'id': glGenTextures(1), 'data': None}
+        glBindTexture(GL_TEXTURE_3D, texture['id'])
+
+        if texture['data'] is not data or (texture['format'], texture['type']) != (format_, type_):
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+            glTexImage3D(GL_TEXTURE_3D, 0, format_, width, height, depth, 0, format_, type_,
+                         np.ascontiguousarray(data))
+            for parameter in (GL_TEXTURE_MAG_FILTER, GL_TEXTURE_MIN_FILTER):
+                glTexParameteri(GL_TEXTURE_3D, parameter, GL_NEAREST)
+            for parameter in (GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_TEXTURE_WRAP_R):
+                glTexParameteri(GL_TEXTURE_3D, parameter, GL_CLAMP_TO_EDGE)
+            self.count(width, height*depth, format_, type_)
+
+        texture.update(data=data, format=format_, type=type_)
+        return texture['id']
+
+    def update(self, data, previous, format_, type_):
+        changed = data != previous
+        if changed.ndim == 3:
+            changed = changed.any(axis=2)
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows) == 0:
+            return
+        top, bottom = rows[0], rows[-1] + 1
+        cols = np.flatnonzero(changed[top:bottom].any(axis=0))
+        left, right = cols[0], cols[-1] + 1
+
+        region = np.ascontiguousarray(data[top:bottom, left:right])
+        glTexSubImage2D(GL_TEXTURE_2D, 0, int(left), int(top), int(right - left), int(bottom - top),
+                        format_, type_, region)
+        self.count(right - left, bottom - top, format_, type_)
+
+    def release(self, key):
+        texture = self.textures.pop(key, None)
+        if texture is not None:
+            glDeleteTextures([texture['id']])
+
+
+class Pyramid:
+    def __init__(self, pixels, tile=512):
+        self.tile = tile
+        self.levels = [pixels]
+        # coarser levels are appended by a background thread; readers use what is there
+        self.thread = threading.Thread(target=self.build, daemon=True)
+        self.thread.start()
+
+    def build(self):
+        level = self.levels[0]
+        while max(level.shape[:2]) > self.tile:
+            level = self.downsample(level)
+            self.levels.append(level)
+
+    def downsample(self, pixels):
+        height, width = pixels.shape[:2]
+        pad = ((0, height % 2), (0, width % 2)) + ((0, 0),)*(pixels.ndim - 2)
+        padded = np.pad(pixels, pad, mode='edge')
+        blocks = padded.reshape((padded.shape[0]//2, 2, padded.shape[1]//2, 2) + padded.shape[2:])
+        mean = blocks.mean(axis=(1, 3), dtype=np.float32)
+        if pixels.dtype.kind in 'ui':
+            np.rint(mean, out=mean)
+        return mean.astype(pixels.dtype)
+
+    def level(self, scale):
+        # scale is image pixels per screen pixel
+        wanted = int(np.log2(scale)) if scale >= 2 else 0
+        return min(wanted, len(self.levels) - 1)
+
+    def tiles(self, level, top, bottom, left, right):
+        height, width = self.levels[0].shape[:2]
+        size = self.tile << level
+        rows = range(max(int(top)//size, 0), min(int(np.ceil(bottom/size)), -(-height//size)))
+        cols = range(max(int(left)//size, 0), min(int(np.ceil(right/size)), -(-width//size)))
+        return [(level, row, col) for row in rows for col in cols]
+
+    def data(self, key):
+        level, row, col = key
+        pixels = self.levels[level]
+        return np.ascontiguousarray(pixels[row*self.tile:(row + 1)*self.tile, col*self.tile:(col + 1)*self.tile])
+
+    def extent(self, key):
+        level, row, col = key
+        height, width = self.levels[0].shape[:2]
+        size = self.tile << level
+        return row*size, min((row + 1)*size, height), col*size, min((col + 1)*size, width)
+
+
+class TileCache:
+    def __init__(self, manager, capacity=64):
+        self.manager = manager
+        self.capacity = capacity
+        self.resident = OrderedDict()
+
+    def bind(self, pyramid, key, format_=GL_LUMINANCE, type_=GL_UNSIGNED_BYTE):
+        data = self.resident.get(key)
+        if data is None:
+            data = self.resident[key] = pyramid.data(key)
+            while len(self.resident) > self.capacity:
+                evicted, _ = self.resident.popitem(last=False)
+                self.manager.release(('tile',) + evicted)
+        else:
+            self.resident.move_to_end(key)
+        self.manager.bind(('tile',) + key, data, format_, type_)
+        return data
+
+    def clear(self):
+        for key in self.resident:
+            self.manager.release(('tile',) + key)
+        self.resident.clear()
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+def histogram(pixels, bins=4096, range=None):
+    # integer data gets one bin per level, float data a fixed number of bins;
+    # a given range lets histograms of separate chunks be summed
+    if pixels.dtype.kind == 'f':
+        hist, edges = np.histogram(pixels, bins, range)
+        return hist, edges[0], edges[1] - edges[0]
+    lo, hi = range or (int(pixels.min()), int(pixels.max()))
+    hist = np.bincount(np.subtract(pixels.ravel(), lo, dtype=np.intp), minlength=hi - lo + 1)
+    return hist, lo, 1
+
+
+def line(x1, x2, y1, y2):
+    A = y2 - y1
+    B = -(x2 - x1)
+    C = -x1*(y2 - y1) + y2*(x2 - x1)
+    return A, B, C
+
+
+def distance(x1, x2, x3, y1, y2, y3):
+    A, B, C = line(x1, x2, y1, y2)
+    return np.abs(A*x3 + B*y3 + C)/np.sqrt(A**2 + B**2)
+
+
+def triangle(hist):
+    pmin = np.flatnonzero(hist == hist[np.nonzero(hist)].min())[0]
+    pmax = int(np.argmax(hist))
+    if pmin < pmax:
+        # the rarest bin sits below the peak (a roughly symmetric histogram):
+        # start from the far end of whichever tail is longer
+        nonzero = np.flatnonzero(hist)
+        pmin = nonzero[-1] if nonzero[-1] - pmax >= pmax - nonzero[0] else nonzero[0]
+    # scanned from the tail towards the peak so that ties resolve to the outermost bin
+    step = 1 if pmin < pmax else -1
+    x = np.arange(pmin, pmax + step, step)
+    dist = distance(pmin, pmax, x, hist[pmin], hist[pmax], hist[x])
+    return x[np.argmax(dist)]
@@ -0,0 +1,90 @@
+import os
+# a surfaceless Mesa context is all the check needs; both have to be set before OpenGL is imported
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+import ctypes
+import numpy as np
+from OpenGL import EGL
+from OpenGL.GL import *
+import texture
+
+
+def make_context(width=16, height=16):
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError('no EGL display')
+    attributes = (EGL.EGLint*5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+    config, count = EGL.EGLConfig(), EGL.EGLint()
+    if not EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count)) \
+            or not count.value:
+        raise RuntimeError('no EGL config with desktop GL')
+    surface = EGL.eglCreatePbufferSurface(display, config,
+                                          (EGL.EGLint*5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height,
+                                                         EGL.EGL_NONE))
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    if not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise RuntimeError('cannot make the EGL context current')
+
+
+def resident(data, format_, type_, target=GL_TEXTURE_2D):
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    pixels = glGetTexImage(target, 0, format_, type_, outputType=None)
+    return np.frombuffer(pixels, dtype=data.dtype).reshape(data.shape)
+
+
+def check(name, data, format_, type_, target=GL_TEXTURE_2D):
+    manager = texture.TextureManager()
+    failures = []
+
+    def frame(data, expected, label):
+        manager.begin_frame()
+        if target == GL_TEXTURE_3D:
+            manager.bind_volume(name, data, format_, type_)
+        else:
+            manager.bind(name, data, format_, type_)
+        if manager.frame_bytes != expected:
+            failures.append('%s %s: %d bytes uploaded, expected %d' % (name, label, manager.frame_bytes, expected))
+        # float luminance may be stored with 8 bits, so it is compared to that precision
+        tolerance = 1/255 if type_ == GL_FLOAT else 0
+        if not np.allclose(resident(data, format_, type_, target), data, rtol=0, atol=tolerance):
+            failures.append('%s %s: resident texture differs from the data' % (name, label))
+
+    frame(data, data.nbytes, 'first frame')
+    if target == GL_TEXTURE_3D:
+        # Pract_7's drawVolume binds the same volume on every frame and moves layers
+        # through texture coordinates only, so a layer change must not upload anything
+        for layer in ('axial', 'sagittal', 'coronal'):
+            frame(data, 0, '%s layer change' % layer)
+        return failures
+    frame(data, 0, 'same array')
+    frame(data.copy(), 0, 'equal copy')
+    edited, pixel = data.copy(), (data.shape[0]//3, data.shape[1]//2)
+    edited[pixel] = 0 if np.any(data[pixel]) else 1
+    frame(edited, data.itemsize*texture.COMPONENTS[format_], 'single-pixel edit')
+    return failures
+
+
+def main():
+    make_context()
+    rng = np.random.default_rng(0)
+    cases = [
+        ('luminance16', rng.integers(0, 65535, (512, 384), dtype=np.uint16), GL_LUMINANCE, GL_UNSIGNED_SHORT),
+        ('rgb8', rng.integers(0, 255, (256, 320, 3), dtype=np.uint8), GL_RGB, GL_UNSIGNED_BYTE),
+        ('float32', rng.random((128, 128), dtype=np.float32), GL_LUMINANCE, GL_FLOAT),
+        ('volume16', rng.integers(0, 65535, (20, 96, 128), dtype=np.uint16), GL_LUMINANCE, GL_UNSIGNED_SHORT,
+         GL_TEXTURE_3D),
+    ]
+    failures = []
+    for name, data, format_, type_, *target in cases:
+        failures += check(name, data, format_, type_, *target)
+    for failure in failures:
+        print(failure)
+    print('%d cases, %d failures' % (len(cases), len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,192 @@
+import argparse
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage as ndi
+import dicom_io
+import lut
+import threshold
+
+
+class Reslicer:
+    def __init__(self, volume, spacing=(1.0, 1.0, 1.0), capacity=32, order=1):
+        self.volume = volume
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        self.capacity = capacity
+        self.order = order
+        self.planes = OrderedDict()
+
+    def axes(self, theta, phi):
+        # the normal starts along z (an axial plane), tilts by theta about x, then by phi about y;
+        # vectors are (z, y, x) like the volume's indices
+        t, p = np.radians(theta), np.radians(phi)
+        tilt = np.array([[np.cos(t), -np.sin(t), 0],
+                         [np.sin(t), np.cos(t), 0],
+                         [0, 0, 1]])
+        turn = np.array([[np.cos(p), 0, -np.sin(p)],
+                         [0, 1, 0],
+                         [np.sin(p), 0, np.cos(p)]])
+        rotation = turn @ tilt
+        normal, v, u = rotation.T
+        return u, v, normal
+
+    def center(self):
+        return (np.array(self.volume.shape[:3]) - 1)/2*self.spacing
+
+    def plane(self, theta=0.0, phi=0.0, offset=0.0, shape=None, step=1.0):
+        key = (round(theta, 6), round(phi, 6), round(offset, 6), shape, step)
+        if key in self.planes:
+            self.planes.move_to_end(key)
+            return self.planes[key]
+
+        rows, cols = shape or self.volume.shape[1:3]
+        u, v, normal = self.axes(theta, phi)
+        origin = self.center() + offset*normal - (rows - 1)/2*step*v - (cols - 1)/2*step*u
+        i, j = np.ogrid[:rows, :cols]
+        points = origin + (i*step)[..., None]*v + (j*step)[..., None]*u
+        coordinates = np.moveaxis(points/self.spacing, -1, 0)
+
+        pixels = ndi.map_coordinates(self.volume, coordinates, output=np.float32, order=self.order,
+                                     mode='constant', cval=0)
+        if self.volume.dtype.kind in 'ui':
+            np.clip(pixels, 0, lut.white(self.volume.dtype), out=pixels)
+            np.rint(pixels, out=pixels)
+        pixels = pixels.astype(self.volume.dtype)
+
+        last = ((rows - 1)*step, (cols - 1)*step)
+        corners = np.array([origin, origin + last[1]*u, origin + last[0]*v + last[1]*u, origin + last[0]*v])
+        self.planes[key] = pixels, corners
+        while len(self.planes) > self.capacity:
+            self.planes.popitem(last=False)
+        return self.planes[key]
+
+
+class Series:
+    # a DICOM series read slab by slab in modality values, so it never has to fit in memory
+    def __init__(self, path):
+        with ThreadPoolExecutor() as pool:
+            self.files, self.ds = dicom_io.series_files(path, pool)
+        self.slope, self.intercept = dicom_io.rescale(self.ds)
+        self.dtype = dicom_io.modality_dtype(self.ds)
+        self.shape = (len(self.files), self.ds[0x280010].value, self.ds[0x280011].value)
+
+    def __getitem__(self, index):
+        files = self.files[index]
+        slab = np.empty((len(files),) + self.shape[1:], dtype=self.dtype)
+        for i, name in enumerate(files):
+            slab[i] = lut.modality(dicom_io.read_file(name)[1], self.slope, self.intercept, self.dtype)
+        return slab
+
+
+def open_source(source):
+    if isinstance(source, Series):
+        return source
+    if os.path.isdir(source):
+        return Series(source)
+    return np.load(source, mmap_mode='r')
+
+
+def gaussian(slab, sigma=1.0):
+    return ndi.gaussian_filter(slab, sigma, output=np.float32)
+
+
+def sobel(slab):
+    magnitude = np.zeros(slab.shape, dtype=np.float32)
+    for axis in range(3):
+        gradient = ndi.sobel(slab, axis, output=np.float32)
+        magnitude += np.square(gradient, out=gradient)
+    return np.sqrt(magnitude, out=magnitude)
+
+
+def mask(slab, tresh, white=1.0):
+    return np.where(slab >= tresh, np.float32(white), np.float32(0))
+
+
+# each filter with the halo it needs: gaussian_filter reaches int(4*sigma + 0.5) slices out
+FILTERS = {
+    'gaussian': (gaussian, lambda sigma=1.0: int(4*sigma + 0.5)),
+    'sobel': (sobel, lambda: 1),
+    'mask': (mask, lambda tresh, white=1.0: 0),
+}
+
+# set once per worker process by open_worker
+SOURCE, TARGET = None, None
+
+
+def open_worker(source, target):
+    global SOURCE, TARGET
+    SOURCE, TARGET = open_source(source), target
+
+
+def read_slab(start, stop):
+    return np.asarray(SOURCE[start:stop], dtype=np.float32)
+
+
+def chunk_range(start, stop):
+    slab = SOURCE[start:stop]
+    return slab.min().item(), slab.max().item()
+
+
+def chunk_histogram(start, stop, range):
+    return threshold.histogram(SOURCE[start:stop], range=range)[0]
+
+
+def chunk_filter(name, args, start, stop, halo):
+    lo, hi = max(start - halo, 0), min(stop + halo, SOURCE.shape[0])
+    result = FILTERS[name][0](read_slab(lo, hi), *args)[start - lo:stop - lo]
+    out = np.load(TARGET, mmap_mode='r+')
+    if out.dtype.kind in 'ui':
+        info = np.iinfo(out.dtype)
+        np.clip(result, info.min, info.max, out=result)
+        np.rint(result, out=result)
+    out[start:stop] = result
+    out.flush()
+    return stop - start
+
+
+def chunks(depth, size):
+    return [(start, min(start + size, depth)) for start in range(0, depth, size)]
+
+
+def filter_volume(source, target, name, args=(), chunk=16, workers=None):
+    # z-slabs go to the worker processes with a halo of neighbouring slices and are written
+    # straight into the .npy output, so memory stays bounded by the slab size
+    volume = open_source(source)
+    shared = volume if isinstance(volume, Series) else source
+    dtype = volume.dtype
+    np.lib.format.open_memmap(target, mode='w+', dtype=dtype, shape=volume.shape).flush()
+    slabs = chunks(volume.shape[0], chunk)
+
+    with ProcessPoolExecutor(workers, initializer=open_worker, initargs=(shared, target)) as pool:
+        if name == 'threshold':
+            # two passes like segment: the global histogram first, then the mask
+            ranges = list(pool.map(chunk_range, *zip(*slabs)))
+            lo, hi = min(r[0] for r in ranges), max(r[1] for r in ranges)
+            futures = [pool.submit(chunk_histogram, start, stop, (lo, hi)) for start, stop in slabs]
+            hist = sum(future.result() for future in futures)
+            step = (hi - lo)/len(hist) if dtype.kind == 'f' else 1
+            name, args = 'mask', (lo + step*threshold.triangle(hist[:-1]), lut.white(dtype))
+        halo = FILTERS[name][1](*args)
+        futures = [pool.submit(chunk_filter, name, args, start, stop, halo) for start, stop in slabs]
+        return sum(future.result() for future in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Filter a DICOM series or .npy volume chunk by chunk.')
+    parser.add_argument('input', help='series folder or .npy volume')
+    parser.add_argument('output', help='.npy file')
+    parser.add_argument('--filter', default='gaussian', help='gaussian:SIGMA, sobel or threshold')
+    parser.add_argument('--chunk', type=int, default=16, help='slices per chunk')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    name, *values = args.filter.split(':')
+    if name not in ('gaussian', 'sobel', 'threshold'):
+        parser.error('unknown filter: ' + name)
+    filter_volume(args.input, args.output, name, [float(value) for value in values], args.chunk, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())